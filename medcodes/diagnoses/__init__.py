@@ -3,6 +3,15 @@ Diagnoses
 =========
 """
 
-from .comorbidities import elixhauser, charlson, custom_comorbidities, comorbidities
+from .comorbidities import elixhauser, charlson, custom_comorbidities, comorbidities, comorbidity_matrix, wide_comorbidity_matrix, comorbidity_bits, decode_bitmask, CompiledMapper, mapper_report, validate_icd_codes, infer_icd_version, codes_for
+from .scoring import charlson_index, elixhauser_index
+from .streaming import comorbidities_from_file
+from .lookback import lookback_comorbidities
+from .aggregates import PatientAggregates, ComorbidityStats
+from .store import ComorbidityStore
 
-__all__ = ['elixhauser','charlson','custom_comorbidities','comorbidities']
+__all__ = ['elixhauser','charlson','custom_comorbidities','comorbidities','comorbidity_matrix',
+           'wide_comorbidity_matrix','comorbidity_bits','decode_bitmask','CompiledMapper',
+           'mapper_report','validate_icd_codes','infer_icd_version','codes_for',
+           'charlson_index','elixhauser_index','comorbidities_from_file','lookback_comorbidities',
+           'PatientAggregates','ComorbidityStats','ComorbidityStore']
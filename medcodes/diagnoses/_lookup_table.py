@@ -0,0 +1,95 @@
+"""
+Lookup Table
+============
+Every valid ICD code is enumerated in `icd9cm` and `icd10`, so the comorbidities of
+the whole vocabulary can be computed once and looked up with a single hash lookup.
+Tables are cached on disk in a file keyed by the contents of the mappers and the
+vocabulary, so that later processes load them instead of recomputing them.
+
+The cache directory is ``~/.cache/medcodes`` and can be changed with the
+``MEDCODES_CACHE_DIR`` environment variable.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from medcodes.diagnoses._prefix_index import PrefixIndex
+
+# Part of the cache key. Increment it when the matching semantics or the file layout
+# change, so that tables cached by earlier versions are not loaded.
+_FORMAT_VERSION = 1
+
+def cache_dir():
+    """Gets the directory where lookup tables are cached."""
+    default = os.path.join(os.path.expanduser('~'), '.cache', 'medcodes')
+    return os.environ.get('MEDCODES_CACHE_DIR', default)
+
+def _cache_key(mappers, vocabularies):
+    """Hashes the format version, the mappers and their vocabularies."""
+    digest = hashlib.sha256(f'format={_FORMAT_VERSION}'.encode())
+    for name, mapper in mappers.items():
+        digest.update(json.dumps([name, mapper, sorted(vocabularies[name])]).encode())
+    return digest.hexdigest()[:16]
+
+def build_lookup_tables(mappers, vocabularies):
+    """
+    Computes the comorbidity bitmask of every code in the vocabulary of each mapper.
+
+    Parameters
+    ----------
+    mappers : dict
+        Dictionary of ``{name: {category: [prefix, ...]}}``.
+    vocabularies : dict
+        Dictionary of ``{name: codes}`` with the codes to look up for each mapper.
+
+    Returns
+    -------
+    dict
+        Dictionary of ``{name: {code: bitmask}}``.
+    """
+    tables = {}
+    for name, mapper in mappers.items():
+        codes = pd.Series(list(vocabularies[name]), dtype=object)
+        masks = PrefixIndex(mapper).match_masks(codes)
+        tables[name] = dict(zip(codes.tolist(), masks.tolist()))
+    return tables
+
+def load_lookup_tables(mappers, vocabularies):
+    """
+    Loads lookup tables from the cache, building and caching them if needed.
+
+    Takes the same parameters and returns the same tables as build_lookup_tables().
+    If the cache directory cannot be written to, tables are built in memory only. A
+    cache file that cannot be read, for example because it is truncated, is rebuilt.
+    """
+    path = os.path.join(cache_dir(), f'comorbidity_lookup_{_cache_key(mappers, vocabularies)}.npz')
+    try:
+        with np.load(path, allow_pickle=False) as cached:
+            return {name: dict(zip(cached[f'{name}_codes'].tolist(), cached[f'{name}_masks'].tolist()))
+                    for name in mappers}
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        pass
+
+    tables = build_lookup_tables(mappers, vocabularies)
+    arrays = {}
+    for name, table in tables.items():
+        arrays[f'{name}_codes'] = np.array(list(table.keys()), dtype=str)
+        arrays[f'{name}_masks'] = np.array(list(table.values()), dtype=np.uint64)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+    except OSError:
+        return tables
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+    return tables
@@ -1,5 +1,6 @@
 from .elixhauser_charlson import comorbidity_mappers
+from .comorbidity_weights import comorbidity_weights, comorbidity_hierarchies, comorbidity_aliases
 from .icd9_descriptions import icd9cm
 from .icd10_descriptions import icd10
 
-__all__ = ['icd9cm', 'comorbidity_mappers', 'icd10']
\ No newline at end of file
+__all__ = ['icd9cm', 'comorbidity_mappers', 'comorbidity_weights', 'comorbidity_hierarchies', 'comorbidity_aliases', 'icd10']
@@ -0,0 +1,167 @@
+charlson_weights_v9 = {
+    'AIDS/HIV': 6,
+    'cerebrovascular disease': 1,
+    'chronic pulmonary disease': 1,
+    'congestive heart failure': 1,
+    'dementia': 1,
+    'diabetes with chronic complication': 2,
+    'diabetes without chronic complication': 1,
+    'hemiplegia': 2,
+    'malignancy': 2,
+    'metastatic solid tumor': 6,
+    'mild liver disease': 1,
+    'moderateor severe liver disease': 3,
+    'myocardial infarction': 1,
+    'peptic ulcer disease': 1,
+    'peripheral vascular disease': 1,
+    'renal disease': 2,
+    'rheumatic disease': 1
+    }
+
+charlson_weights_v10 = {
+    'AIDS/HIV': 6,
+    'cerebrovascular disease': 1,
+    'chronic pulmonary disease': 1,
+    'congestive heart failure': 1,
+    'dementia': 1,
+    'diabetes with chronic complication': 2,
+    'diabetes without chronic complication': 1,
+    'hemiplegia or paraplegia': 2,
+    'malignancy': 2,
+    'metastatic solid tumor': 6,
+    'mild liver disease': 1,
+    'moderate or severe liver disease': 3,
+    'myocardial infarction': 1,
+    'peptic ulcer disease': 1,
+    'peripheral vascular disease': 1,
+    'renal disease': 2,
+    'rheumatic disease': 1
+    }
+
+elixhauser_weights_V9 = {
+    'AIDS/HIV': 0,
+    'alcohol abuse': 0,
+    'blood loss anemia': -2,
+    'cardiac arrhythmias': 5,
+    'chronic pulmonary disease': 3,
+    'coagulopathy': 3,
+    'congestive heart failure': 7,
+    'deficiency anemia': -2,
+    'depression': -3,
+    'diabetes,  complicated': 0,
+    'diabetes,  uncomplicated': 0,
+    'drugabuse': -7,
+    'fluid and electrolyte disorders': 5,
+    'hypertension,  complicated': 0,
+    'hypertension,  uncomplicated': 0,
+    'hypothyroidism': 0,
+    'liver disease': 11,
+    'lymphoma': 9,
+    'metastatic cancer': 12,
+    'obesity': -4,
+    'other neurological disorders': 6,
+    'paralysis': 7,
+    'peptic ulcer disease excluding bleeding': 0,
+    'peripheral vascular disorders': 2,
+    'psychoses': 0,
+    'pulmonary circulation disorders': 4,
+    'renal failure': 5,
+    'rheumatoid arthritis': 0,
+    'solid tumor metastasis': 4,
+    'valvular disease': -1,
+    'weight loss': 6
+    }
+
+elixhauser_weights_V10 = {
+    'AIDS/HIV': 0,
+    'alcohol abuse': 0,
+    'blood loss anemia': -2,
+    'cardiac arrhythmias': 5,
+    'chronic pulmonary disease': 3,
+    'coagulopathy': 3,
+    'congestive heart failure': 7,
+    'deficiency anemia': -2,
+    'depression': -3,
+    'diabetes, complicated': 0,
+    'diabetes, uncomplicated': 0,
+    'drug abuse': -7,
+    'fluid and electrolyte disorders': 5,
+    'hypertension, complicated': 0,
+    'hypertension, uncomplicated': 0,
+    'hypothyroidism': 0,
+    'liver disease': 11,
+    'lymphoma': 9,
+    'metastatic cancer': 12,
+    'obesity': -4,
+    'other neurological disorders': 6,
+    'paralysis': 7,
+    'peptic ulcer diease excluding bleeding': 0,
+    'peripheral vascular disorders': 2,
+    'psychoses': 0,
+    'pulmonary circulation disorders': 4,
+    'renal failure': 5,
+    'rheumatoid arthritis': 0,
+    'valvular disease': -1,
+    'weight loss': 6
+    }
+
+# (superior, inferior) pairs: a patient with the superior category is only
+# scored for it, not for the inferior one.
+charlson_hierarchy_v9 = [
+    ('diabetes with chronic complication', 'diabetes without chronic complication'),
+    ('metastatic solid tumor', 'malignancy'),
+    ('moderateor severe liver disease', 'mild liver disease')
+    ]
+
+charlson_hierarchy_v10 = [
+    ('diabetes with chronic complication', 'diabetes without chronic complication'),
+    ('metastatic solid tumor', 'malignancy'),
+    ('moderate or severe liver disease', 'mild liver disease')
+    ]
+
+elixhauser_hierarchy_V9 = [
+    ('diabetes,  complicated', 'diabetes,  uncomplicated'),
+    ('hypertension,  complicated', 'hypertension,  uncomplicated'),
+    ('metastatic cancer', 'solid tumor metastasis')
+    ]
+
+elixhauser_hierarchy_V10 = [
+    ('diabetes, complicated', 'diabetes, uncomplicated'),
+    ('hypertension, complicated', 'hypertension, uncomplicated')
+    ]
+
+
+comorbidity_weights = {
+    'charlson_9': charlson_weights_v9,
+    'charlson_10': charlson_weights_v10,
+    'elixhauser_9': elixhauser_weights_V9,
+    'elixhauser_10': elixhauser_weights_V10
+}
+
+comorbidity_hierarchies = {
+    'charlson_9': charlson_hierarchy_v9,
+    'charlson_10': charlson_hierarchy_v10,
+    'elixhauser_9': elixhauser_hierarchy_V9,
+    'elixhauser_10': elixhauser_hierarchy_V10
+}
+
+# ICD-9 categories that are named differently in the ICD-10 mapper, mapped to their
+# ICD-10 name, so that flags from both versions are scored once per condition.
+charlson_aliases = {
+    'hemiplegia': 'hemiplegia or paraplegia',
+    'moderateor severe liver disease': 'moderate or severe liver disease'
+    }
+
+elixhauser_aliases = {
+    'diabetes,  complicated': 'diabetes, complicated',
+    'diabetes,  uncomplicated': 'diabetes, uncomplicated',
+    'drugabuse': 'drug abuse',
+    'hypertension,  complicated': 'hypertension, complicated',
+    'hypertension,  uncomplicated': 'hypertension, uncomplicated',
+    'peptic ulcer disease excluding bleeding': 'peptic ulcer diease excluding bleeding'
+    }
+
+comorbidity_aliases = {
+    'charlson': charlson_aliases,
+    'elixhauser': elixhauser_aliases
+}
@@ -0,0 +1,110 @@
+"""
+Packed Codes
+============
+Packs formatted ICD codes into 64-bit integers that sort in the same order as the
+codes themselves. Each character is a base-37 digit (padding, then ``0-9``, then
+``A-Z``), and codes are left-aligned on ``WIDTH`` digits, so that:
+
+* every code starting with prefix ``P`` packs into ``[pack(P), pack(P) + 37 ** (WIDTH - len(P)))``
+* columns of codes are matched against sorted interval bounds with ``np.searchsorted``
+
+Codes longer than ``WIDTH`` or with other characters cannot be packed and are
+returned as -1.
+"""
+
+import numpy as np
+
+WIDTH = 12
+BASE = 37
+
+_DIGITS = np.full(128, -1, dtype=np.int64)
+_DIGITS[0] = 0
+_DIGITS[ord('0'):ord('9') + 1] = np.arange(1, 11)
+_DIGITS[ord('A'):ord('Z') + 1] = np.arange(11, 37)
+_CHARS = np.array(['', *'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'])
+
+
+def pack_codes(icd_codes):
+    """
+    Packs formatted ICD codes into order-preserving integers.
+
+    Parameters
+    ----------
+    icd_codes : pd.Series, np.ndarray or list of str
+        Formatted ICD codes
+
+    Returns
+    -------
+    np.ndarray
+        Array of int64, with -1 for codes that cannot be packed.
+    """
+    codes = np.asarray(icd_codes, dtype=str)
+    if codes.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    n_chars = codes.dtype.itemsize // 4
+    points = codes.view(np.uint32).reshape(len(codes), n_chars)[:, :WIDTH].astype(np.int64)
+    digits = _DIGITS[np.minimum(points, 127)]
+    digits[points > 127] = -1
+    packed = np.zeros(len(codes), dtype=np.int64)
+    for j in range(points.shape[1]):
+        packed = packed * BASE + digits[:, j]
+    packed *= BASE ** (WIDTH - points.shape[1])
+    invalid = (digits < 0).any(axis=1)
+    if n_chars > WIDTH:
+        invalid |= np.char.str_len(codes) > WIDTH
+    packed[invalid] = -1
+    return packed
+
+def unpack_codes(packed):
+    """
+    Converts packed integers back into ICD codes.
+
+    Parameters
+    ----------
+    packed : np.ndarray
+        Array of integers returned by pack_codes().
+
+    Returns
+    -------
+    np.ndarray
+        Array of str.
+    """
+    packed = np.asarray(packed, dtype=np.int64)
+    digits = np.empty((len(packed), WIDTH), dtype=np.int64)
+    for j in range(WIDTH - 1, -1, -1):
+        packed, digits[:, j] = np.divmod(packed, BASE)
+    chars = _CHARS[digits]
+    codes = chars[:, 0]
+    for j in range(1, WIDTH):
+        codes = np.char.add(codes, chars[:, j])
+    return codes
+
+def prefix_bounds(prefix):
+    """
+    Gets the half-open interval of packed codes that start with prefix.
+
+    Returns
+    -------
+    tuple
+        ``(lower, upper)``, or None if prefix cannot be packed.
+    """
+    lower = int(pack_codes([prefix])[0]) if prefix else 0
+    if lower < 0:
+        return None
+    return lower, lower + BASE ** (WIDTH - len(prefix))
+
+def range_bounds(lower, upper):
+    """
+    Gets the half-open interval of packed codes matched by a code range, that is
+    codes at or after lower whose first characters are at or before upper.
+
+    Returns
+    -------
+    tuple
+        ``(lower, upper)``, or None if either bound cannot be packed.
+    """
+    lower_bounds = prefix_bounds(lower)
+    upper_bounds = prefix_bounds(upper)
+    if lower_bounds is None or upper_bounds is None:
+        return None
+    return lower_bounds[0], upper_bounds[1]
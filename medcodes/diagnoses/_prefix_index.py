@@ -0,0 +1,437 @@
+"""
+Prefix Index
+============
+Compiles a comorbidity mapper (a dictionary of ``{category: [prefix, ...]}``) into
+a character trie. Each category is assigned one bit, so looking up an ICD code walks
+at most ``len(icd_code)`` nodes and returns an integer bitmask of matching categories.
+Columns of codes are packed into order-preserving integers (see _packed_codes), so
+that every prefix becomes an interval and whole columns are matched with a single
+``np.searchsorted`` over the sorted interval bounds.
+
+Mappers may also list code ranges such as ``'I20-I25'`` or ``'410.00-410.92'``. A range
+matches every code that sorts after its lower bound and whose first characters sort no
+later than its upper bound, so ``'I20-I25'`` matches ``'I200'`` through ``'I259'``. Ranges
+are compiled into sorted, non-overlapping intervals searched with binary search.
+
+Entries starting with ``'!'`` are exclusions: ``['531-534', '!5310']`` matches codes from
+531 to 534 except those starting with 5310. Exclusions are stored alongside inclusions in
+the same trie nodes and intervals, so both are resolved in a single lookup.
+"""
+
+from bisect import bisect_right
+from collections import Counter, defaultdict
+
+import numpy as np
+import pandas as pd
+
+from medcodes.diagnoses._packed_codes import pack_codes, prefix_bounds, range_bounds
+
+# Sorts after every character used in ICD codes, so that ``hi + _RANGE_END`` is an
+# exclusive upper bound for all codes starting with ``hi``.
+_RANGE_END = '\uffff'
+
+
+def is_exclusion(entry):
+    """Checks whether a mapper entry excludes codes rather than including them."""
+    return entry.startswith('!')
+
+def is_range(entry):
+    """Checks whether a mapper entry is a code range rather than a prefix."""
+    return '-' in entry
+
+def parse_range(entry):
+    """
+    Parses a code range into half-open bounds.
+
+    Parameters
+    ----------
+    entry : str
+        Code range such as ``'I20-I25'``. Dots and whitespace are removed from bounds.
+
+    Returns
+    -------
+    tuple
+        ``(lower, upper)`` such that a formatted code matches if ``lower <= code < upper``.
+    """
+    bounds = [b.replace(".", "").strip() for b in entry.split('-')]
+    if len(bounds) != 2 or not all(bounds) or bounds[0] > bounds[1]:
+        raise ValueError(f"{entry} is not a valid code range.")
+    return bounds[0], bounds[1] + _RANGE_END
+
+def _minimize(entries, collapsed, sign=''):
+    """Minimizes prefixes and ranges, recording removed entries in collapsed."""
+    minimized = []
+    seen = set()
+    for entry in entries:
+        if entry in seen:
+            collapsed.append((sign + entry, 'duplicate', sign + entry))
+        seen.add(entry)
+    for prefix in sorted(p for p in seen if not is_range(p)):
+        if minimized and prefix.startswith(minimized[-1]):
+            collapsed.append((sign + prefix, 'subsumed', sign + minimized[-1]))
+        else:
+            minimized.append(prefix)
+    return minimized + sorted(p for p in seen if is_range(p))
+
+def minimize_prefixes(prefixes, collapsed=None):
+    """
+    Removes duplicate prefixes and prefixes that start with another prefix of the list.
+    Code ranges are kept as they are, after removing duplicates. Inclusions and
+    exclusions are minimized separately.
+
+    Parameters
+    ----------
+    prefixes : list of str
+        Prefixes of one category.
+    collapsed : list
+        If specified, a ``(entry, reason, kept)`` tuple is appended for every removed
+        entry, where `reason` is 'duplicate' or 'subsumed' and `kept` is the entry
+        that still matches its codes.
+
+    Returns
+    -------
+    list of str
+        Sorted prefixes, then sorted ranges, then exclusions in the same order,
+        that match the same codes as `prefixes`.
+    """
+    if collapsed is None:
+        collapsed = []
+    included = _minimize([p for p in prefixes if not is_exclusion(p)], collapsed)
+    excluded = _minimize([p[1:] for p in prefixes if is_exclusion(p)], collapsed, sign='!')
+    return included + ['!' + p for p in excluded]
+
+def minimize_mapper(mapper, report=None):
+    """
+    Applies minimize_prefixes() to every category of a mapper.
+
+    Parameters
+    ----------
+    mapper : dict
+        Dictionary of ``{category: [prefix, ...]}``.
+    report : list
+        If specified, a ``(category, entry, reason, kept)`` tuple is appended
+        for every removed entry.
+
+    Returns
+    -------
+    dict
+        Mapper with the same categories, in the same order.
+    """
+    minimized = {}
+    for category, prefixes in mapper.items():
+        collapsed = []
+        minimized[category] = minimize_prefixes(prefixes, collapsed)
+        if report is not None:
+            report.extend((category,) + c for c in collapsed)
+    return minimized
+
+
+class IntervalIndex(object):
+    """
+    Sorted, non-overlapping intervals over formatted codes (or packed codes), each
+    with the bitmask of the categories whose ranges cover it.
+
+    Parameters
+    ----------
+    intervals : list of tuple
+        List of ``(lower, upper, mask)`` half-open intervals, as returned by parse_range().
+    excluded : list of tuple
+        List of ``(lower, upper, mask)`` half-open intervals whose categories are
+        removed from the bitmask of the intervals they overlap.
+    """
+    def __init__(self, intervals, excluded=()):
+        starts = defaultdict(list)
+        ends = defaultdict(list)
+        for is_excluded, entries in enumerate([intervals, excluded]):
+            for lower, upper, mask in entries:
+                starts[lower].append((mask, is_excluded))
+                ends[upper].append((mask, is_excluded))
+        self.bounds = sorted(set(starts) | set(ends))
+        self.masks = []
+        active = Counter()
+        for bound in self.bounds:
+            for key in ends[bound]:
+                active[key] -= 1
+            for key in starts[bound]:
+                active[key] += 1
+            segment_masks = [0, 0]
+            for (mask, is_excluded), count in active.items():
+                if count:
+                    segment_masks[is_excluded] |= mask
+            self.masks.append(segment_masks[0] & ~segment_masks[1])
+        self._bounds_array = np.array(self.bounds)
+        self._masks_array = np.array(self.masks, dtype=np.uint64)
+
+    def match_mask(self, icd_code):
+        """Gets the bitmask of the interval containing icd_code."""
+        i = bisect_right(self.bounds, icd_code) - 1
+        return self.masks[i] if i >= 0 else 0
+
+    def match_masks(self, icd_codes):
+        """Vectorized version of match_mask() for a pd.Series or np.ndarray of codes."""
+        if not self.bounds:
+            return np.zeros(len(icd_codes), dtype=np.uint64)
+        i = np.searchsorted(self._bounds_array, np.asarray(icd_codes), side='right') - 1
+        masks = self._masks_array[np.maximum(i, 0)]
+        masks[i < 0] = 0
+        return masks
+
+
+class PrefixIndex(object):
+    """
+    Character trie over the prefixes of a comorbidity mapper.
+
+    Parameters
+    ----------
+    mapper : dict
+        Dictionary of ``{category: [prefix, ...]}``. Entries may also be code
+        ranges such as ``'I20-I25'``, and exclusions starting with ``'!'``.
+
+    Attributes
+    ----------
+    categories : tuple of str
+        Categories in mapper order. Category ``i`` is stored as bit ``i``.
+    mask_dtype : np.dtype
+        Smallest unsigned integer type that holds a bitmask of all categories.
+    lookup : dict
+        Optional ``{code: bitmask}`` table of precomputed matches, set with
+        set_lookup(). Codes found in it are resolved with a single hash lookup
+        instead of walking the trie.
+    """
+    def __init__(self, mapper):
+        if len(mapper) > 64:
+            raise ValueError("A mapper can have at most 64 categories.")
+        self.categories = tuple(mapper.keys())
+        self.mask_dtype = np.dtype(np.uint32 if len(mapper) <= 32 else np.uint64)
+        self._root = [0, {}, 0]
+        self._decoded = {}
+        self._tables = None
+        self.lookup = None
+        self._lookup_index = None
+        self._expanded = None
+        intervals = ([], [])
+        for bit, prefixes in enumerate(mapper.values()):
+            for prefix in prefixes:
+                excluded = is_exclusion(prefix)
+                if excluded:
+                    prefix = prefix[1:]
+                if is_range(prefix):
+                    intervals[excluded].append(parse_range(prefix) + (1 << bit,))
+                else:
+                    self._insert(prefix, 1 << bit, excluded)
+        self._ranges = intervals
+        self._intervals = IntervalIndex(intervals[0]) if intervals[0] else None
+        self._excluded_intervals = IntervalIndex(intervals[1]) if intervals[1] else None
+        self._packed = None
+
+    def _insert(self, prefix, mask, excluded=False):
+        # Nodes are [included mask, children, excluded mask].
+        node = self._root
+        for char in prefix:
+            node = node[1].setdefault(char, [0, {}, 0])
+        node[2 if excluded else 0] |= mask
+
+    def set_lookup(self, lookup):
+        """
+        Sets the ``{code: bitmask}`` table of precomputed matches.
+        """
+        self.lookup = lookup
+        self._lookup_index = None
+        self._expanded = None
+        if lookup:
+            self._lookup_index = (pd.Index(list(lookup.keys())),
+                                  np.array(list(lookup.values()), dtype=np.uint64))
+
+    def match_mask(self, icd_code):
+        """
+        Gets the bitmask of categories with a prefix of icd_code.
+
+        Parameters
+        ----------
+        icd_code : str
+            Formatted ICD code
+
+        Returns
+        -------
+        int
+            Bitmask where bit ``i`` is set if ``categories[i]`` matches.
+        """
+        if self.lookup is not None:
+            mask = self.lookup.get(icd_code)
+            if mask is not None:
+                return mask
+        node = self._root
+        mask = node[0]
+        excluded = node[2]
+        for char in icd_code:
+            node = node[1].get(char)
+            if node is None:
+                break
+            mask |= node[0]
+            excluded |= node[2]
+        if self._intervals is not None:
+            mask |= self._intervals.match_mask(icd_code)
+        if self._excluded_intervals is not None:
+            excluded |= self._excluded_intervals.match_mask(icd_code)
+        return mask & ~excluded
+
+    def decode(self, mask):
+        """
+        Converts a bitmask into a list of categories, in mapper order.
+        """
+        categories = self._decoded.get(mask)
+        if categories is None:
+            categories = [c for i, c in enumerate(self.categories) if mask >> i & 1]
+            self._decoded[mask] = categories
+        return list(categories)
+
+    def match(self, icd_code):
+        """
+        Gets the list of categories with a prefix of icd_code, in mapper order.
+        """
+        return self.decode(self.match_mask(icd_code))
+
+    def _prefix_tables(self):
+        """
+        Groups trie nodes by depth into ``{length: (prefixes, masks, excluded_masks)}``.
+        """
+        tables = {}
+        stack = [('', self._root)]
+        while stack:
+            prefix, node = stack.pop()
+            if prefix and (node[0] or node[2]):
+                tables.setdefault(len(prefix), {})[prefix] = (node[0], node[2])
+            for char, child in node[1].items():
+                stack.append((prefix + char, child))
+        return {
+            length: (pd.Index(list(table.keys())),
+                     np.array([m for m, _ in table.values()], dtype=np.uint64),
+                     np.array([m for _, m in table.values()], dtype=np.uint64))
+            for length, table in sorted(tables.items())
+        }
+
+    def match_masks(self, icd_codes):
+        """
+        Vectorized version of match_mask().
+
+        Parameters
+        ----------
+        icd_codes : pd.Series
+            Formatted ICD codes
+
+        Returns
+        -------
+        np.ndarray
+            Array of uint64 bitmasks, one per code.
+        """
+        if self._lookup_index is None:
+            return self._match_prefixes(icd_codes)
+        codes, code_masks = self._lookup_index
+        idx = codes.get_indexer(icd_codes)
+        masks = code_masks[idx]
+        missing = idx < 0
+        if missing.any():
+            masks[missing] = self._match_prefixes(icd_codes[missing])
+        return masks
+
+    def _packed_index(self):
+        """
+        Converts every trie node and range into intervals of packed codes, merged into
+        a single IntervalIndex. Returns False if an entry cannot be packed.
+        """
+        intervals = ([], [])
+        stack = [('', self._root)]
+        while stack:
+            prefix, node = stack.pop()
+            for is_excluded, mask in enumerate([node[0], node[2]]):
+                if mask:
+                    bounds = prefix_bounds(prefix)
+                    if bounds is None:
+                        return False
+                    intervals[is_excluded].append(bounds + (mask,))
+            for char, child in node[1].items():
+                stack.append((prefix + char, child))
+        for is_excluded, ranges in enumerate(self._ranges):
+            for lower, upper, mask in ranges:
+                bounds = range_bounds(lower, upper[:-len(_RANGE_END)])
+                if bounds is None:
+                    return False
+                intervals[is_excluded].append(bounds + (mask,))
+        return IntervalIndex(intervals[0], intervals[1])
+
+    def _match_prefixes(self, icd_codes):
+        """
+        Matches codes with a binary search over packed intervals. Codes that cannot
+        be packed are matched by prefix length instead.
+        """
+        if self._packed is None:
+            self._packed = self._packed_index()
+        if self._packed is False:
+            return self._match_strings(icd_codes)
+        packed = pack_codes(icd_codes)
+        masks = self._packed.match_masks(packed)
+        unpacked = packed < 0
+        if unpacked.any():
+            masks[unpacked] = self._match_strings(icd_codes[unpacked])
+        return masks
+
+    def _match_strings(self, icd_codes):
+        if self._tables is None:
+            self._tables = self._prefix_tables()
+        masks = np.full(len(icd_codes), self._root[0], dtype=np.uint64)
+        excluded = np.full(len(icd_codes), self._root[2], dtype=np.uint64)
+        for length, (prefixes, prefix_masks, excluded_masks) in self._tables.items():
+            idx = prefixes.get_indexer(icd_codes.str[:length])
+            hits = idx >= 0
+            masks[hits] |= prefix_masks[idx[hits]]
+            excluded[hits] |= excluded_masks[idx[hits]]
+        if self._intervals is not None:
+            masks |= self._intervals.match_masks(icd_codes)
+        if self._excluded_intervals is not None:
+            excluded |= self._excluded_intervals.match_masks(icd_codes)
+        return masks & ~excluded
+
+    def decode_masks(self, masks):
+        """
+        Vectorized version of decode(). Rows with the same bitmask
+        share the same list of categories.
+        """
+        uniques, inverse = np.unique(masks, return_inverse=True)
+        decoded = np.empty(len(uniques), dtype=object)
+        for i, mask in enumerate(uniques):
+            decoded[i] = self.decode(int(mask))
+        return decoded[inverse.ravel()]
+
+    def expand(self, codes=None):
+        """
+        Groups codes by the categories they match, as a reverse index from
+        categories to codes.
+
+        Parameters
+        ----------
+        codes : iterable of str
+            Formatted codes to group. If not specified, the codes of the lookup
+            table, in which case the result is computed once and cached.
+
+        Returns
+        -------
+        dict
+            Dictionary of ``{category: np.ndarray}`` with the sorted codes of
+            each category.
+        """
+        if codes is None:
+            if self._expanded is None:
+                if self._lookup_index is None:
+                    raise ValueError("No lookup table is set. Pass codes to expand.")
+                lookup_codes, masks = self._lookup_index
+                self._expanded = self._group_codes(lookup_codes.to_numpy(dtype=str), masks)
+            return self._expanded
+        codes = np.asarray(list(codes), dtype=str)
+        return self._group_codes(codes, self.match_masks(pd.Series(codes, dtype=object)))
+
+    def _group_codes(self, codes, masks):
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        masks = masks[order]
+        return {category: codes[(masks >> np.uint64(bit) & np.uint64(1)).astype(bool)]
+                for bit, category in enumerate(self.categories)}
@@ -0,0 +1,400 @@
+"""
+Aggregates
+==========
+Patient-level comorbidity results of separate partitions of a claims table can be
+combined without going back to the claims: comorbidities combine with a bitwise OR,
+first and last dates with a min and a max, and claim counts with a sum. Each of
+these is associative and commutative, so partitions can be processed by any number
+of processes or machines, serialized, and merged in any order.
+
+Prevalence and co-occurrence statistics are accumulated the same way, in memory that
+only depends on the number of categories, as chunks of codes or bitmasks are fed.
+"""
+
+import io
+import json
+
+import numpy as np
+import pandas as pd
+
+from medcodes.diagnoses.comorbidities import (_check_errors, _check_mapping, _claim_masks, _factorize_and_match,
+                                              _get_mapper, _masks_to_flags, _reduce_masks)
+
+
+def _remap_masks(masks, categories, new_categories):
+    """Moves the bits of masks from the order of categories to the order of new_categories."""
+    if list(categories) == list(new_categories):
+        return masks
+    remapped = np.zeros(len(masks), dtype=np.uint64)
+    for bit, category in enumerate(categories):
+        has_category = masks >> np.uint64(bit) & np.uint64(1)
+        remapped |= has_category << np.uint64(new_categories.index(category))
+    return remapped
+
+def _date_range(groups, days, n_groups):
+    """Gets the first and last date of each group, ignoring missing dates."""
+    first_last = pd.Series(days).groupby(groups).agg(['min', 'max']).reindex(range(n_groups))
+    return (first_last['min'].to_numpy(dtype='datetime64[D]'),
+            first_last['max'].to_numpy(dtype='datetime64[D]'))
+
+class PatientAggregates(object):
+    """
+    Comorbidities, first and last claim dates and claim counts of a set of patients,
+    that can be merged with the aggregates of other claims of the same or other patients.
+
+    Parameters
+    ----------
+    categories : list of str
+        Comorbidity categories. Category ``i`` is stored as bit ``i``.
+    patient_ids : pd.Index
+        Identifiers of the patients, without duplicates.
+    masks : np.ndarray
+        Comorbidity bitmask of each patient.
+    first_seen, last_seen : np.ndarray
+        Dates of the first and last claim of each patient, as datetime64[D].
+    counts : np.ndarray
+        Number of claims of each patient.
+
+    Example
+    -------
+    >>> parts = [PatientAggregates.from_claims(claims, mapping='charlson') for claims in partitions]
+    >>> merged = functools.reduce(PatientAggregates.merge, parts)
+    >>> merged.to_frame()
+    """
+    def __init__(self, categories, patient_ids, masks, first_seen, last_seen, counts):
+        if len(categories) > 64:
+            raise ValueError("Aggregates support at most 64 categories.")
+        self.categories = list(categories)
+        self.patient_ids = pd.Index(patient_ids)
+        self.masks = np.asarray(masks, dtype=np.uint64)
+        self.first_seen = np.asarray(first_seen, dtype='datetime64[D]')
+        self.last_seen = np.asarray(last_seen, dtype='datetime64[D]')
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    def __repr__(self):
+        return f'PatientAggregates(categories={len(self.categories)}, patients={len(self)})'
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    @classmethod
+    def empty(cls, categories):
+        """Creates aggregates of no patients."""
+        return cls(categories, pd.Index([]), np.zeros(0, dtype=np.uint64),
+                   np.zeros(0, dtype='datetime64[D]'), np.zeros(0, dtype='datetime64[D]'),
+                   np.zeros(0, dtype=np.int64))
+
+    @classmethod
+    def from_claims(cls, claims, patient_col='patient_id', code_col='icd_code', date_col='date',
+                    version_col=None, icd_version=9, mapping='elixhauser', custom_map=None,
+                    errors='raise'):
+        """
+        Aggregates the claims of each patient.
+
+        Parameters
+        ----------
+        claims : pd.DataFrame
+            Claims table with one ICD code per row. Missing codes are skipped.
+        patient_col : str
+            Column with patient identifiers.
+        code_col : str
+            Column with ICD codes.
+        date_col : str
+            Column with service dates. If None, dates are missing.
+        version_col : str
+            Optional column with the ICD version (9 or 10) of each row. If not
+            specified, every row is assumed to be `icd_version`.
+        icd_version : int
+            Version of ICD codes when `version_col` is not specified.
+            Can be either 9 or 10.
+        mapping : str
+            Type of comorbiditiy mapping. Can be one of 'elixhauser',
+            'charlson', 'custom'.
+        custom_map : dict or CompiledMapper
+            Custom mapper dictionary. Used when mapping is set to 'custom'.
+        errors : str
+            How to handle invalid codes. Can be one of 'raise', 'coerce',
+            'ignore'. See comorbidities().
+
+        Returns
+        -------
+        PatientAggregates
+        """
+        _check_errors(errors)
+        masks = _claim_masks(claims, [code_col], version_col, icd_version, mapping, custom_map, errors)
+        categories = list(dict.fromkeys(c for version_categories, _ in masks for c in version_categories))
+        claim_masks = np.zeros(len(claims), dtype=np.uint64)
+        for version_categories, version_masks in masks:
+            claim_masks |= _remap_masks(version_masks, version_categories, categories)
+
+        patients, patient_ids = pd.factorize(claims[patient_col])
+        rows = patients >= 0
+        if date_col is None:
+            days = np.full(len(claims), np.datetime64('NaT'), dtype='datetime64[D]')
+        else:
+            days = pd.to_datetime(claims[date_col], errors='coerce').to_numpy().astype('datetime64[D]')
+        first_seen, last_seen = _date_range(patients[rows], days[rows], len(patient_ids))
+        return cls(categories, pd.Index(patient_ids, name=patient_col),
+                   _reduce_masks(patients[rows], claim_masks[rows], len(patient_ids)),
+                   first_seen, last_seen, np.bincount(patients[rows], minlength=len(patient_ids)))
+
+    def merge(self, other):
+        """
+        Combines two aggregates. Comorbidities are combined with a bitwise OR, first
+        and last dates with a min and a max and claim counts with a sum. Categories
+        are the union of the categories of both aggregates.
+
+        Parameters
+        ----------
+        other : PatientAggregates
+
+        Returns
+        -------
+        PatientAggregates
+            New aggregates of the patients of both aggregates.
+        """
+        categories = list(dict.fromkeys(self.categories + other.categories))
+        masks = _remap_masks(self.masks, self.categories, categories).copy()
+        other_masks = _remap_masks(other.masks, other.categories, categories)
+        first_seen = self.first_seen.copy()
+        last_seen = self.last_seen.copy()
+        counts = self.counts.copy()
+
+        positions = self.patient_ids.get_indexer(other.patient_ids)
+        known = positions >= 0
+        stored = positions[known]
+        masks[stored] |= other_masks[known]
+        first_seen[stored] = np.fmin(first_seen[stored], other.first_seen[known])
+        last_seen[stored] = np.fmax(last_seen[stored], other.last_seen[known])
+        counts[stored] += other.counts[known]
+
+        new_ids = other.patient_ids[~known]
+        patient_ids = self.patient_ids.append(new_ids) if len(self) else new_ids
+        return PatientAggregates(categories, patient_ids,
+                                 np.concatenate([masks, other_masks[~known]]),
+                                 np.concatenate([first_seen, other.first_seen[~known]]),
+                                 np.concatenate([last_seen, other.last_seen[~known]]),
+                                 np.concatenate([counts, other.counts[~known]]))
+
+    def to_frame(self, patient_ids=None):
+        """
+        Gets the aggregates of patients as a dataframe.
+
+        Parameters
+        ----------
+        patient_ids : list, pd.Series or np.ndarray
+            Patients to get. If not specified, returns every patient.
+
+        Returns
+        -------
+        pd.DataFrame
+            Dataframe indexed by patient with one boolean column per comorbidity
+            and `first_seen`, `last_seen` and `count` columns. Unknown patients
+            have no comorbidities, missing dates and a count of 0.
+        """
+        if patient_ids is None:
+            positions = np.arange(len(self))
+            index = self.patient_ids
+        else:
+            index = pd.Index(patient_ids, name=self.patient_ids.name)
+            positions = self.patient_ids.get_indexer(index)
+        known = positions >= 0
+        masks = np.zeros(len(positions), dtype=np.uint64)
+        first_seen = np.full(len(positions), np.datetime64('NaT'), dtype='datetime64[D]')
+        last_seen = first_seen.copy()
+        counts = np.zeros(len(positions), dtype=np.int64)
+        masks[known] = self.masks[positions[known]]
+        first_seen[known] = self.first_seen[positions[known]]
+        last_seen[known] = self.last_seen[positions[known]]
+        counts[known] = self.counts[positions[known]]
+
+        frame = pd.DataFrame(_masks_to_flags([(self.categories, masks)], len(positions)), index=index)
+        frame['first_seen'] = first_seen.astype('datetime64[ns]')
+        frame['last_seen'] = last_seen.astype('datetime64[ns]')
+        frame['count'] = counts
+        return frame
+
+    def _to_arrays(self):
+        """Gets the aggregates as a dictionary of arrays that can be saved without pickling."""
+        patient_ids = self.patient_ids.to_numpy()
+        if patient_ids.dtype == object:
+            patient_ids = patient_ids.astype(str)
+        return {'categories': np.array(json.dumps(self.categories)), 'patient_ids': patient_ids,
+                'masks': self.masks, 'first_seen': self.first_seen, 'last_seen': self.last_seen,
+                'counts': self.counts}
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        return cls(json.loads(str(arrays['categories'])), arrays['patient_ids'], arrays['masks'],
+                   arrays['first_seen'], arrays['last_seen'], arrays['counts'])
+
+    def to_bytes(self):
+        """
+        Serializes the aggregates into a compressed ``.npz`` payload, to be sent
+        between processes or machines or written to a file.
+
+        Returns
+        -------
+        bytes
+        """
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **self._to_arrays())
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Deserializes aggregates serialized with to_bytes().
+
+        Returns
+        -------
+        PatientAggregates
+        """
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return cls._from_arrays(arrays)
+
+class ComorbidityStats(object):
+    """
+    Streaming accumulator of the prevalence and co-occurrence of comorbidities.
+    Each chunk is reduced to its distinct bitmasks and their counts, so that
+    memory use does not depend on the number of rows fed.
+
+    Parameters
+    ----------
+    mapping : str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser',
+        'charlson', 'custom'.
+    icd_version : int
+        Version of ICD codes. Can be either 9 or 10.
+    custom_map : dict or CompiledMapper
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+
+    Attributes
+    ----------
+    categories : tuple of str
+        Categories of the mapper. Category ``i`` is stored as bit ``i``.
+    n : int
+        Number of rows fed.
+    counts : np.ndarray
+        Number of rows with each category.
+    pair_counts : np.ndarray
+        Number of rows with both categories ``i`` and ``j``, with ``counts``
+        on the diagonal.
+
+    Example
+    -------
+    >>> stats = ComorbidityStats(mapping='charlson')
+    >>> for chunk in pd.read_csv('claims.csv', dtype={'icd_code': str}, chunksize=1000000):
+    ...     stats.update(chunk['icd_code'])
+    >>> stats.prevalence()
+    >>> stats.cooccurrence()
+    """
+    def __init__(self, mapping='elixhauser', icd_version=9, custom_map=None):
+        _check_mapping(mapping)
+        if icd_version not in [9,10]:
+            raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+        self.icd_version = icd_version
+        self._mapper = _get_mapper(mapping, icd_version, custom_map)
+        self.categories = self._mapper.categories
+        self.n = 0
+        self.counts = np.zeros(len(self.categories), dtype=np.int64)
+        self.pair_counts = np.zeros((len(self.categories), len(self.categories)), dtype=np.int64)
+
+    def __repr__(self):
+        return f'ComorbidityStats(categories={len(self.categories)}, n={self.n})'
+
+    def _add(self, masks, weights):
+        """Adds bitmasks that occur a number of times given by weights."""
+        distinct, inverse = np.unique(masks, return_inverse=True)
+        weights = np.bincount(inverse.ravel(), weights=weights, minlength=len(distinct)).astype(np.int64)
+        bits = (distinct[:, None] >> np.arange(len(self.categories), dtype=np.uint64) & np.uint64(1))
+        bits = bits.astype(np.int64)
+        self.n += int(weights.sum())
+        self.counts += weights @ bits
+        self.pair_counts += (bits * weights[:, None]).T @ bits
+
+    def update(self, icd_codes, errors='raise'):
+        """
+        Adds a chunk of ICD codes, one row per code. Each distinct code is mapped once.
+
+        Parameters
+        ----------
+        icd_codes : list, pd.Series or np.ndarray
+            ICD codes
+        errors : str
+            How to handle invalid codes. Can be one of 'raise', 'coerce',
+            'ignore'. See comorbidities().
+
+        Returns
+        -------
+        ComorbidityStats
+            The updated accumulator.
+        """
+        _check_errors(errors)
+        codes = icd_codes if isinstance(icd_codes, pd.Series) else pd.Series(icd_codes, dtype=object)
+        inverse, _, masks = _factorize_and_match(codes, self.icd_version, self._mapper, errors)
+        self._add(masks, np.bincount(inverse, minlength=len(masks)))
+        return self
+
+    def update_masks(self, masks):
+        """
+        Adds a chunk of bitmasks with the categories of the accumulator, one row
+        per bitmask, such as the output of comorbidities() with as_bitmask=True or
+        the masks of PatientAggregates for patient-level statistics.
+
+        Returns
+        -------
+        ComorbidityStats
+            The updated accumulator.
+        """
+        masks = np.asarray(masks, dtype=np.uint64)
+        self._add(masks, np.ones(len(masks)))
+        return self
+
+    def merge(self, other):
+        """
+        Adds the statistics of another accumulator with the same categories.
+
+        Returns
+        -------
+        ComorbidityStats
+            The updated accumulator.
+        """
+        if list(other.categories) != list(self.categories):
+            raise ValueError("Only accumulators with the same categories can be merged.")
+        self.n += other.n
+        self.counts += other.counts
+        self.pair_counts += other.pair_counts
+        return self
+
+    def prevalence(self):
+        """
+        Gets the number and proportion of rows with each category.
+
+        Returns
+        -------
+        pd.DataFrame
+            Dataframe indexed by category with columns `count` and `prevalence`.
+        """
+        prevalence = self.counts / self.n if self.n else np.zeros(len(self.counts))
+        return pd.DataFrame({'count': self.counts, 'prevalence': prevalence},
+                            index=pd.Index(self.categories, name='comorbidity'))
+
+    def cooccurrence(self, normalize=False):
+        """
+        Gets the number of rows with each pair of categories.
+
+        Parameters
+        ----------
+        normalize : bool
+            If True, returns proportions of rows instead of counts.
+
+        Returns
+        -------
+        pd.DataFrame
+            Square dataframe indexed and labelled by category.
+        """
+        pair_counts = self.pair_counts
+        if normalize:
+            pair_counts = pair_counts / self.n if self.n else np.zeros(pair_counts.shape)
+        return pd.DataFrame(pair_counts, index=list(self.categories), columns=list(self.categories))
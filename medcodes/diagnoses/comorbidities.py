@@ -9,30 +9,135 @@ The comorbidity functions in this module are used to cluster diagnoses into como
 comorbidity mapping indices such as Elixhauser, Charlson, or a custom mapper.
 """
 
+import re
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
 
 from medcodes.diagnoses._mappers import comorbidity_mappers, icd9cm, icd10
+from medcodes.diagnoses._prefix_index import PrefixIndex, minimize_mapper
+from medcodes.diagnoses._lookup_table import load_lookup_tables
 
 icd9_codes = icd9cm.keys()
 icd10_codes = icd10.keys()
 
+_ICD10_START = np.datetime64('2015-10-01')
+
+_compiled_mappers = {k: PrefixIndex(minimize_mapper(mapper)) for k, mapper in comorbidity_mappers.items()}
+
 def _check_icd_inputs(icd_code, icd_version):
     """Checks that icd_code input is the correct format."""
     if icd_version not in [9,10]:
         raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
     if not isinstance(icd_code, str):
         raise TypeError("icd_code must be a string.")
-    if (icd_version==10 and icd_code not in icd10_codes):
+    formatted = _format_icd_code(icd_code, icd_version)
+    if (icd_version==10 and formatted not in icd10_codes):
         raise ValueError(f"{icd_code} is not a recognized ICD-10 code.")
-    if (icd_version==9 and icd_code not in icd9_codes):
+    if (icd_version==9 and formatted not in icd9_codes):
         raise ValueError(f"{icd_code} is not a recognized ICD-9CM code.")
 
-def _format_icd_code(icd_code):
-    """Removes punctuation from icd_code string."""
-    icd_code = icd_code.replace(".", "")
-    icd_code = icd_code.strip()
+def _check_icd_codes(icd_codes, formatted, icd_version):
+    """
+    Vectorized version of _check_icd_inputs() for a pd.Series of codes and
+    the same codes formatted with _format_icd_codes().
+    """
+    if pd.api.types.infer_dtype(icd_codes, skipna=False) not in ['string', 'empty']:
+        raise TypeError("icd_code must be a string.")
+    vocab = icd9_codes if icd_version == 9 else icd10_codes
+    known = formatted.isin(vocab).to_numpy()
+    if not known.all():
+        _check_icd_inputs(icd_codes.iloc[np.argmin(known)], icd_version)
+
+def _check_mapping(mapping):
+    if mapping not in ['elixhauser', 'charlson', 'custom']:
+        raise ValueError("mapping must be one of 'elixhauser', 'charlson', 'custom'")
+
+def _check_mappings(mapping):
+    """Checks that mapping is a mapping name or a list of mapping names and returns a list."""
+    mappings = [mapping] if isinstance(mapping, str) else list(mapping)
+    if not mappings:
+        raise ValueError("mapping must be one of 'elixhauser', 'charlson', 'custom'")
+    for m in mappings:
+        _check_mapping(m)
+    return list(dict.fromkeys(mappings))
+
+def _check_errors(errors):
+    if errors not in ['raise', 'coerce', 'ignore']:
+        raise ValueError("errors must be one of 'raise', 'coerce', 'ignore'")
+
+def _check_versions(versions):
+    """Checks that every per-row ICD version is 9 or 10. Missing versions are rejected."""
+    if not np.isin(versions, [9,10]).all():
+        raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+
+def _version_rows(claims, version_col, icd_version):
+    """
+    Gets the positions of the rows of claims of each ICD version, as a dictionary of
+    ``{version: rows}``. Every row is `icd_version` if `version_col` is None.
+    """
+    if version_col is None:
+        return {icd_version: np.arange(len(claims))}
+    versions = claims[version_col].to_numpy()
+    _check_versions(versions)
+    groups = pd.Series(np.arange(len(claims))).groupby(versions).indices
+    return {int(version): rows for version, rows in groups.items()}
+
+def _icd_code_reasons(icd_codes, formatted, icd_version):
+    """
+    Gets the validation status of each code in a pd.Series of codes and the same
+    codes formatted with _format_icd_codes(). Can be one of 'valid', 'missing',
+    'not_string' or 'unknown'.
+    """
+    vocab = icd9_codes if icd_version == 9 else icd10_codes
+    reasons = np.full(len(icd_codes), 'valid', dtype=object)
+    reasons[~formatted.isin(vocab).to_numpy()] = 'unknown'
+    is_string = np.fromiter((isinstance(c, str) for c in icd_codes), dtype=bool, count=len(icd_codes))
+    reasons[~is_string] = 'not_string'
+    reasons[~is_string & icd_codes.isna().to_numpy()] = 'missing'
+    return reasons
+
+# Zero-pads the category of dotted codes, e.g. '4.1' -> '004.1' and 'V2.1' -> 'V02.1'.
+# ICD-9 E codes have 3-digit categories and ICD-10 E codes have 2-digit categories.
+_DOTTED_PADDING = {
+    9: [(re.compile(r'^(\d)\.'), r'00\1.'), (re.compile(r'^(\d\d)\.'), r'0\1.'),
+        (re.compile(r'^V(\d)\.'), r'V0\1.'), (re.compile(r'^E(\d)\.'), r'E00\1.'),
+        (re.compile(r'^E(\d\d)\.'), r'E0\1.')],
+    10: [(re.compile(r'^(\d)\.'), r'00\1.'), (re.compile(r'^(\d\d)\.'), r'0\1.'),
+         (re.compile(r'^V(\d)\.'), r'V0\1.'), (re.compile(r'^E(\d)\.'), r'E0\1.')],
+}
+
+@lru_cache(maxsize=65536)
+def _format_icd_code(icd_code, icd_version=9):
+    """
+    Removes whitespace and punctuation from icd_code string and converts it to
+    uppercase. The category of dotted codes is zero-padded, so that '4.1',
+    'v2.1' and 'E8.1' become '0041', 'V021' and 'E0081' in ICD-9.
+    """
+    icd_code = ''.join(icd_code.split()).upper()
+    if '.' in icd_code:
+        for pattern, repl in _DOTTED_PADDING[icd_version]:
+            icd_code = pattern.sub(repl, icd_code)
+        icd_code = icd_code.replace('.', '')
     return icd_code
 
+def _format_icd_codes(icd_codes, icd_version=9):
+    """
+    Vectorized version of _format_icd_code() for a pd.Series of codes.
+    Values that are not strings are returned as NaN.
+    """
+    if pd.api.types.infer_dtype(icd_codes, skipna=False) not in ['string', 'empty']:
+        is_string = np.fromiter((isinstance(c, str) for c in icd_codes), dtype=bool,
+                                count=len(icd_codes))
+        icd_codes = icd_codes.where(is_string)
+    icd_codes = icd_codes.astype('string').str.replace(r'\s+', '', regex=True).str.upper()
+    if icd_codes.str.contains('.', regex=False).any():
+        for pattern, repl in _DOTTED_PADDING[icd_version]:
+            icd_codes = icd_codes.str.replace(pattern.pattern, repl, regex=True)
+        icd_codes = icd_codes.str.replace('.', '', regex=False)
+    return icd_codes.astype(object).where(icd_codes.notna(), np.nan)
+
 def _check_custom_map(custom_map):
     """Checks that vals of custom_map dict are dictionaries."""
     if not isinstance(custom_map, dict):
@@ -41,6 +146,200 @@ def _check_custom_map(custom_map):
         if not isinstance(val, list):
             raise TypeError(f'{k} values must be a list')
 
+def _load_lookup_tables():
+    """Attaches the full-vocabulary lookup tables to the compiled mappers."""
+    vocabularies = {k: icd9_codes if k.endswith('_9') else icd10_codes for k in comorbidity_mappers}
+    tables = load_lookup_tables(comorbidity_mappers, vocabularies)
+    for k, mapper in _compiled_mappers.items():
+        mapper.set_lookup(tables[k])
+
+def _get_mapper(mapping, icd_version, custom_map=None):
+    """Gets the compiled PrefixIndex for a mapping and ICD version."""
+    if mapping == 'custom':
+        if isinstance(custom_map, CompiledMapper):
+            return custom_map.index
+        _check_custom_map(custom_map)
+        return PrefixIndex(minimize_mapper(custom_map))
+    if icd_version not in [9,10]:
+        raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+    mapper = _compiled_mappers[f'{mapping}_{int(icd_version)}']
+    if mapper.lookup is None:
+        _load_lookup_tables()
+    return mapper
+
+def _reduce_masks(groups, masks, n_groups):
+    """
+    Combines bitmasks with a bitwise OR per group.
+
+    Parameters
+    ----------
+    groups : np.ndarray
+        Group number of each row, between 0 and n_groups - 1.
+    masks : np.ndarray
+        Bitmask of each row.
+    n_groups : int
+        Number of groups.
+
+    Returns
+    -------
+    np.ndarray
+        Array of n_groups bitmasks.
+    """
+    reduced = np.zeros(n_groups, dtype=np.uint64)
+    if len(groups) == 0:
+        return reduced
+    order = np.argsort(groups, kind='stable')
+    groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    reduced[groups[starts]] = np.bitwise_or.reduceat(masks[order], starts)
+    return reduced
+
+def _factorize_and_check(icd_codes, icd_version, errors='raise'):
+    """
+    Formats and validates each distinct code in icd_codes once.
+    If errors is 'coerce', invalid codes are not matched. If errors is 'ignore',
+    codes are not validated and every string is matched.
+
+    Returns
+    -------
+    tuple
+        ``(inverse, formatted, matched)`` where ``formatted`` is a pd.Series of distinct
+        formatted codes, ``matched`` flags the distinct codes to match and ``inverse``
+        maps each row of icd_codes back to its distinct code.
+    """
+    if icd_version not in [9,10]:
+        raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+    inverse, uniques = pd.factorize(icd_codes, use_na_sentinel=False)
+    uniques = pd.Series(uniques, dtype=object)
+    formatted = _format_icd_codes(uniques, icd_version)
+    if errors == 'raise':
+        _check_icd_codes(uniques, formatted, icd_version)
+        return inverse, formatted, np.ones(len(uniques), dtype=bool)
+
+    reasons = _icd_code_reasons(uniques, formatted, icd_version)
+    if errors == 'coerce':
+        matched = reasons == 'valid'
+    else:
+        matched = (reasons == 'valid') | (reasons == 'unknown')
+    return inverse, formatted, matched
+
+def _match_formatted(mapper, formatted, matched):
+    """Gets the bitmask of each formatted code, with an empty bitmask for codes not matched."""
+    if matched.all():
+        return mapper.match_masks(formatted)
+    masks = np.zeros(len(formatted), dtype=np.uint64)
+    masks[matched] = mapper.match_masks(formatted[matched])
+    return masks
+
+def _factorize_and_match(icd_codes, icd_version, mapper, errors='raise'):
+    """
+    Formats, validates and matches each distinct code in icd_codes once.
+    See _factorize_and_check().
+
+    Returns
+    -------
+    tuple
+        ``(inverse, formatted, masks)`` where ``masks`` holds one bitmask per
+        distinct code.
+    """
+    inverse, formatted, matched = _factorize_and_check(icd_codes, icd_version, errors)
+    return inverse, formatted, _match_formatted(mapper, formatted, matched)
+
+def _comorbidities_columns(codes, icd_version, mappings, mappers, as_bitmask, errors='raise'):
+    """
+    Computes the description column and one comorbidity column for each mapping and its
+    compiled mapper, as a dictionary of np.ndarray. Codes are formatted, validated and
+    described once for all mappings.
+    """
+    inverse, formatted, matched = _factorize_and_check(codes, icd_version, errors)
+
+    vocab = icd9cm if icd_version == 9 else icd10
+    descriptions = formatted.map(vocab).to_numpy(dtype=object)
+    columns = {'description': descriptions[inverse]}
+    for mapping, mapper in zip(mappings, mappers):
+        masks = _match_formatted(mapper, formatted, matched)
+        if as_bitmask:
+            comorbidity = masks.astype(mapper.mask_dtype)[inverse]
+        else:
+            comorbidity = mapper.decode_masks(masks)[inverse]
+        columns[f'{mapping.lower()}_comorbidity'] = comorbidity
+    return columns
+
+def _comorbidities_table(codes, icd_version, mappings, mappers, as_bitmask, errors='raise'):
+    """Builds the output of comorbidities() for a pd.Series of codes of one ICD version."""
+    columns = _comorbidities_columns(codes, icd_version, mappings, mappers, as_bitmask, errors)
+    return pd.DataFrame({'icd_code': codes, **columns}, index=codes.index)
+
+def _mixed_comorbidities_table(codes, versions, mappings, custom_map, as_bitmask, errors):
+    """
+    Builds the output of comorbidities() when each code has its own ICD version.
+    Rows of each version are processed as one vectorized group, and the results are
+    written back into columns in input order.
+    """
+    groups = pd.Series(np.arange(len(codes))).groupby(versions).indices
+    mappers = {version: [_get_mapper(m, version, custom_map) for m in mappings] for version in groups}
+    if as_bitmask and len(groups) > 1:
+        categories = [[mapper.categories for mapper in version_mappers]
+                      for version_mappers in mappers.values()]
+        if any(c != categories[0] for c in categories):
+            raise ValueError("as_bitmask requires the mappers of every ICD version to have the "
+                             "same categories. Use as_bitmask=False or one icd_version.")
+
+    columns = {}
+    for version, rows in groups.items():
+        group_columns = _comorbidities_columns(codes.iloc[rows], version, mappings, mappers[version],
+                                               as_bitmask, errors)
+        for c, values in group_columns.items():
+            if c not in columns:
+                columns[c] = np.empty(len(codes), dtype=values.dtype)
+            columns[c][rows] = values
+    return pd.DataFrame({'icd_code': codes, **columns}, index=codes.index)
+
+def infer_icd_version(icd_codes, service_dates=None):
+    """
+    Infers the ICD version of each code from its service date or its shape.
+
+    Codes with a service date on or after October 1, 2015, when ICD-10 replaced
+    ICD-9CM in the United States, are ICD-10 and earlier codes are ICD-9CM. Codes
+    without a service date are ICD-9CM if they start with a digit and ICD-10 if
+    they start with a letter other than E or V. E and V codes are ICD-10 if they
+    are only found in ICD-10 and ICD-9CM otherwise.
+
+    Parameters
+    ----------
+    icd_codes : list, pd.Series or np.ndarray
+        ICD codes
+    service_dates : list, pd.Series or np.ndarray
+        Optional date of service of each code.
+
+    Returns
+    -------
+    np.ndarray
+        ICD version of each code, 9 or 10. Can be passed as `icd_version`
+        to comorbidities().
+
+    Example
+    -------
+    >>> infer_icd_version(['4254', 'I252', 'V427'])
+    >>> infer_icd_version(['E000', 'E000'], service_dates=['2014-05-01', '2016-05-01'])
+    """
+    codes = icd_codes if isinstance(icd_codes, pd.Series) else pd.Series(icd_codes, dtype=object)
+    inverse, uniques = pd.factorize(codes, use_na_sentinel=False)
+    formatted = _format_icd_codes(pd.Series(uniques, dtype=object)).fillna('')
+    first = formatted.str[:1].to_numpy(dtype=object)
+    is_letter = formatted.str.match(r'[A-Z]').to_numpy(dtype=bool)
+    only_icd10 = (formatted.isin(icd10_codes) & ~formatted.isin(icd9_codes)).to_numpy()
+    is_icd10 = np.where(np.isin(first, ['E', 'V']), only_icd10, is_letter)
+    versions = np.where(is_icd10, 10, 9)[inverse]
+
+    if service_dates is not None:
+        dates = pd.to_datetime(pd.Series(service_dates), errors='coerce').to_numpy()
+        if len(dates) != len(codes):
+            raise ValueError("service_dates must have the same length as icd_codes.")
+        has_date = ~pd.isna(dates)
+        versions[has_date] = np.where(dates[has_date] >= _ICD10_START, 10, 9)
+    return versions
+
 def charlson(icd_code, icd_version=9):
     """
     Identifies relevant Charlson comorbidities for a ICD code of interest.
@@ -69,16 +368,10 @@ def charlson(icd_code, icd_version=9):
     Med Care. 2005 Nov; 43(11): 1130-9.
     """
     _check_icd_inputs(icd_code=icd_code, icd_version=icd_version)
-    icd_code = _format_icd_code(icd_code=icd_code)
-
-    mapper = comorbidity_mappers[f'charlson_{icd_version}']
+    icd_code = _format_icd_code(icd_code, icd_version)
 
-    comorbidities = []
-
-    for k, val in mapper.items():
-        if icd_code.startswith(tuple(val)):
-            comorbidities.append(k)
-    return comorbidities
+    mapper = _get_mapper('charlson', icd_version)
+    return mapper.match(icd_code)
 
 def elixhauser(icd_code, icd_version=9):
     """
@@ -108,15 +401,10 @@ def elixhauser(icd_code, icd_version=9):
     Med Care. 2005 Nov; 43(11): 1130-9.
     """
     _check_icd_inputs(icd_code=icd_code, icd_version=icd_version)
-    icd_code = _format_icd_code(icd_code=icd_code)
-
-    mapper = comorbidity_mappers[f'elixhauser_{icd_version}']
+    icd_code = _format_icd_code(icd_code, icd_version)
 
-    comorbidities = []
-    for k, val in mapper.items():
-        if icd_code.startswith(tuple(val)):
-            comorbidities.append(k)
-    return comorbidities
+    mapper = _get_mapper('elixhauser', icd_version)
+    return mapper.match(icd_code)
 
 def custom_comorbidities(icd_code, icd_version, custom_map):
     """
@@ -128,9 +416,11 @@ def custom_comorbidities(icd_code, icd_version, custom_map):
         International Classification of Diseases (ICD) code
     icd_version : int
         Version of ICD. Can be either 9 or 10.
-    custom_map : dict
+    custom_map : dict or CompiledMapper
         A customized mapper that defines one group of 
-        multiple groups of ICD codes.
+        multiple groups of ICD codes. Each group is a list of code
+        prefixes (e.g. '410') or code ranges (e.g. 'I20-I25'). Entries
+        starting with '!' exclude codes from the group (e.g. '!5310').
     
     Returns
     -------
@@ -146,37 +436,57 @@ def custom_comorbidities(icd_code, icd_version, custom_map):
     >>> custom_map = {'stroke': ['33']}
     >>> icd_code = '33010'
     >>> custom_comorbidities(icd_code=icd_code, icd_version=9, custom_map=custom_map)
+    >>> custom_map = {'peptic ulcer without bleeding': ['531-534', '!5310', '!5312', '!5314']}
+    >>> custom_comorbidities(icd_code='5317', icd_version=9, custom_map=custom_map)
     """
     _check_icd_inputs(icd_code=icd_code, icd_version=icd_version)
-    icd_code = _format_icd_code(icd_code=icd_code)
+    icd_code = _format_icd_code(icd_code, icd_version)
+    if isinstance(custom_map, CompiledMapper):
+        return custom_map.index.match(icd_code)
     _check_custom_map(custom_map)
+    return PrefixIndex(minimize_mapper(custom_map)).match(icd_code)
 
-    comorbidities = []
-    for k, val in custom_map.items():
-        if icd_code.startswith(tuple(val)):
-            comorbidities.append(k)
-    return comorbidities
-
-def comorbidities(icd_codes, icd_version=9, mapping='elixhauser', custom_map=None):
+def comorbidities(icd_codes, icd_version=9, mapping='elixhauser', custom_map=None, as_bitmask=False,
+                  errors='raise'):
     """
     Parameters
     ----------
-    icd_codes : list
-        List of ICD codes
-    icd_version : int
+    icd_codes : list, pd.Series or np.ndarray
+        ICD codes. Codes are factorized and each distinct code is formatted,
+        validated and matched once, column-wise, before results are broadcast
+        back to every row. Formatting removes whitespace and dots, converts
+        codes to uppercase and zero-pads the category of dotted codes, so
+        that '425.4', ' 4254 ' and '4254' are the same code.
+    icd_version : int, list, pd.Series or np.ndarray
         Version of ICD codes. Can be either 9 or 10. 
-        Note that version 9 refers to ICD-9CM.
-    mapping : str
+        Note that version 9 refers to ICD-9CM. If an array, the version of
+        each code, such as the output of infer_icd_version(). Codes of each
+        version are processed together and rows are kept in input order.
+        If both `icd_codes` and `icd_version` are pd.Series, versions are
+        aligned to codes by index label; otherwise they are matched by position.
+    mapping : str or list of str
         Type of comorbiditiy mapping. Can be one of 'elixhauser', 
         'charlson', 'custom'. If custom mapping is desired, the mapper must
-        be specified in `custom_map`.
-    custom_map : dict
+        be specified in `custom_map`. If a list, codes are validated and
+        described once and one comorbidity column is added per mapping.
+    custom_map : dict or CompiledMapper
         Custom mapper dictionary. Used when mapping is set to 'custom'.
+    as_bitmask : bool
+        If True, comorbidities are encoded as an unsigned integer bitmask
+        per row instead of a list of names. See comorbidity_bits() for the
+        category-to-bit table and decode_bitmask() to convert back.
+    errors : str
+        How to handle codes that are not strings or are not recognized ICD codes.
+        If 'raise', raises an error. If 'coerce', invalid codes get no description
+        and no comorbidities. If 'ignore', codes are not validated: strings are
+        matched against the mapper even if they are not recognized.
 
     Returns
     -------
     pd.DataFrame
-        Dataframe with columns `icd_code`, `description`, `comorbidity`.
+        Dataframe with columns `icd_code`, `description` and one
+        `<mapping>_comorbidity` column per mapping.
+        If `icd_codes` is a pd.Series, its index is preserved.
     
     Note
     ----
@@ -188,34 +498,553 @@ def comorbidities(icd_codes, icd_version=9, mapping='elixhauser', custom_map=Non
     defining Comorbidities in ICD-9-CM and ICD-10 administrative data. 
     Med Care. 2005 Nov; 43(11): 1130-9.
     """
-    if mapping not in ['elixhauser', 'charlson', 'custom']:
-        raise ValueError("mappign must be one of 'elixhauser', 'charlson', 'custom'")
+    mappings = _check_mappings(mapping)
 
     if custom_map:
-        if not isinstance(custom_map, dict):
+        if not isinstance(custom_map, (dict, CompiledMapper)):
             raise TypeError("custom_map must be a dictionary")
 
-    all_comorbidities = []
-    descriptions = []
-    for icd_code in icd_codes:
-        c = None
-        if mapping == 'custom':
-            c = custom_comorbidities(icd_code, icd_version, custom_map)
-        if mapping == 'elixhauser':
-            c = elixhauser(icd_code, icd_version)
-        if mapping == 'charlson':
-            c = charlson(icd_code, icd_version)
-        all_comorbidities.append(c)
-        d = None
-        if icd_version == 9:
-            d = icd9cm[icd_code]
-        if icd_version == 10:
-            d = icd10[icd_code]
-        descriptions.append(d)
-    comorbidities_table = pd.DataFrame({'icd_code': icd_codes, 
-                                        'description': descriptions, 
-                                        f'{mapping.lower()}_comorbidity': all_comorbidities})
-
-    return comorbidities_table
+    _check_errors(errors)
+    codes = icd_codes if isinstance(icd_codes, pd.Series) else pd.Series(icd_codes, dtype=object)
+    if np.ndim(icd_version) > 0:
+        if isinstance(icd_version, pd.Series) and isinstance(icd_codes, pd.Series):
+            if not codes.index.isin(icd_version.index).all():
+                raise ValueError("icd_version must have a version for every label of icd_codes.")
+            icd_version = icd_version.reindex(codes.index)
+        versions = np.asarray(icd_version)
+        if len(versions) != len(codes):
+            raise ValueError("icd_version must be a single version or have the same length as icd_codes.")
+        _check_versions(versions)
+        if len(np.unique(versions)) > 1:
+            return _mixed_comorbidities_table(codes, versions, mappings, custom_map, as_bitmask,
+                                              errors)
+        icd_version = versions[0] if len(versions) else 9
+
+    mappers = [_get_mapper(m, icd_version, custom_map) for m in mappings]
+    return _comorbidities_table(codes, icd_version, mappings, mappers, as_bitmask, errors)
+
+def _patient_masks(claims, patient_col, code_col, version_col, icd_version, mapping, custom_map,
+                   errors='raise'):
+    """
+    Computes the bitmask of comorbidities of each patient in claims.
+
+    Returns
+    -------
+    tuple
+        ``(patient_ids, masks)`` where ``masks`` is a list of ``(categories, patient_masks)``,
+        one for each ICD version found in claims.
+    """
+    _check_mapping(mapping)
+
+    patients, patient_ids = pd.factorize(claims[patient_col], sort=True)
+    codes = claims[code_col].reset_index(drop=True).astype(object)
+    versions = _version_rows(claims, version_col, icd_version)
+
+    custom_mapper = _get_mapper(mapping, None, custom_map) if mapping == 'custom' else None
+    masks = []
+    for version, rows in versions.items():
+        mapper = custom_mapper or _get_mapper(mapping, version)
+        rows = rows[patients[rows] >= 0]
+        inverse, _, code_masks = _factorize_and_match(codes.iloc[rows], version, mapper, errors)
+        patient_masks = _reduce_masks(patients[rows], code_masks[inverse], len(patient_ids))
+        masks.append((mapper.categories, patient_masks))
+    if not masks:
+        mapper = custom_mapper or _get_mapper(mapping, icd_version)
+        masks.append((mapper.categories, np.zeros(len(patient_ids), dtype=np.uint64)))
+    return patient_ids, masks
 
+def _masks_to_flags(masks, n_rows):
+    """
+    Converts a list of ``(categories, masks)`` into a dictionary of boolean flags
+    per category, using the union of categories.
+    """
+    categories = list(dict.fromkeys(c for version_categories, _ in masks for c in version_categories))
+    flags = {c: np.zeros(n_rows, dtype=bool) for c in categories}
+    for version_categories, row_masks in masks:
+        for bit, category in enumerate(version_categories):
+            flags[category] |= (row_masks >> np.uint64(bit) & np.uint64(1)).astype(bool)
+    return flags
+
+def comorbidity_matrix(claims, patient_col='patient_id', code_col='icd_code', version_col=None,
+                       icd_version=9, mapping='elixhauser', custom_map=None, sparse=False, errors='raise'):
+    """
+    Builds a patient-level comorbidity matrix from a long claims table.
+
+    Parameters
+    ----------
+    claims : pd.DataFrame
+        Claims table with one ICD code per row.
+    patient_col : str
+        Column with patient identifiers.
+    code_col : str
+        Column with ICD codes.
+    version_col : str
+        Optional column with the ICD version (9 or 10) of each row. If not
+        specified, every row is assumed to be `icd_version`.
+    icd_version : int
+        Version of ICD codes when `version_col` is not specified.
+        Can be either 9 or 10.
+    mapping : str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser', 
+        'charlson', 'custom'.
+    custom_map : dict or CompiledMapper
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+    sparse : bool or str
+        If False, returns a dense dataframe. If 'csr', returns a
+        scipy.sparse.csr_matrix (requires SciPy). If 'coo', returns a
+        ``(rows, cols)`` pair of np.ndarray with the position of every
+        True flag, sorted by row then column.
+    errors : str
+        How to handle invalid codes. Can be one of 'raise', 'coerce',
+        'ignore'. See comorbidities().
+
+    Returns
+    -------
+    pd.DataFrame or tuple
+        Dataframe indexed by patient with one boolean column per comorbidity.
+        When ICD-9 and ICD-10 rows are mixed, columns are the union of the
+        categories of both mappers. If `sparse` is set, returns a tuple
+        ``(matrix, patient_ids, categories)`` where `patient_ids` and
+        `categories` label the rows and columns of `matrix`.
+
+    Example
+    -------
+    >>> claims = pd.DataFrame({'patient_id': [1, 1, 2], 'icd_code': ['4254', '40403', '0010']})
+    >>> comorbidity_matrix(claims, mapping='charlson')
+    """
+    if sparse not in [False, 'csr', 'coo']:
+        raise ValueError("sparse must be one of False, 'csr', 'coo'")
+    _check_errors(errors)
+    patient_ids, masks = _patient_masks(claims, patient_col, code_col, version_col,
+                                        icd_version, mapping, custom_map, errors)
+
+    categories = list(dict.fromkeys(c for version_categories, _ in masks for c in version_categories))
+    if not sparse:
+        matrix = pd.DataFrame(_masks_to_flags(masks, len(patient_ids)),
+                              index=pd.Index(patient_ids, name=patient_col))
+        return matrix
+
+    positions = [np.array([], dtype=np.intp)]
+    for version_categories, patient_masks in masks:
+        for bit, category in enumerate(version_categories):
+            rows = np.flatnonzero(patient_masks >> np.uint64(bit) & np.uint64(1))
+            positions.append(rows * len(categories) + categories.index(category))
+    positions = np.unique(np.concatenate(positions))
+    rows, cols = np.divmod(positions, len(categories))
+    patient_ids = pd.Index(patient_ids, name=patient_col)
+    if sparse == 'coo':
+        return (rows, cols), patient_ids, categories
+    try:
+        from scipy.sparse import csr_matrix
+    except ImportError:
+        raise ImportError("sparse='csr' requires scipy. Use sparse='coo' instead.")
+    matrix = csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                        shape=(len(patient_ids), len(categories)))
+    return matrix, patient_ids, categories
+
+def _claim_masks(claims, code_cols, version_col, icd_version, mapping, custom_map, errors='raise'):
+    """
+    Computes the bitmask of comorbidities of each claim of a claims table, one code
+    column at a time. Missing codes and empty or blank strings are skipped.
+
+    Returns
+    -------
+    list
+        List of ``(categories, claim_masks)``, one for each ICD version found in claims.
+    """
+    _check_mapping(mapping)
+
+    versions = _version_rows(claims, version_col, icd_version)
+
+    masks = []
+    for version, rows in versions.items():
+        mapper = _get_mapper(mapping, version, custom_map)
+        claim_masks = np.zeros(len(claims), dtype=np.uint64)
+        for col in code_cols:
+            codes = claims[col].astype(object)
+            if version_col is not None:
+                codes = codes.iloc[rows]
+            # Codes are factorized once; missing codes and blank strings are dropped
+            # from the distinct codes before they are validated and matched.
+            inverse, uniques = pd.factorize(codes)
+            is_blank = np.fromiter((isinstance(c, str) and not c.strip() for c in uniques),
+                                   dtype=bool, count=len(uniques))
+            keep = np.flatnonzero(~is_blank)
+            unique_inverse, _, code_masks = _factorize_and_match(pd.Series(uniques[keep], dtype=object),
+                                                                 version, mapper, errors)
+            unique_masks = np.zeros(len(uniques), dtype=np.uint64)
+            unique_masks[keep] = code_masks[unique_inverse]
+            present = inverse >= 0
+            claim_masks[rows[present]] |= unique_masks[inverse[present]]
+        masks.append((mapper.categories, claim_masks))
+    if not masks:
+        mapper = _get_mapper(mapping, icd_version, custom_map)
+        masks.append((mapper.categories, np.zeros(0, dtype=np.uint64)))
+    return masks
+
+def wide_comorbidity_matrix(claims, code_cols, patient_col=None, version_col=None, icd_version=9,
+                            mapping='elixhauser', custom_map=None, errors='raise'):
+    """
+    Builds a claim-level or patient-level comorbidity matrix from a wide claims table
+    with several diagnosis columns, such as ``dx1`` to ``dx25``. Columns are processed
+    one at a time and their comorbidities are combined, so that the table does not
+    need to be melted into a long table first.
 
+    Parameters
+    ----------
+    claims : pd.DataFrame
+        Claims table with one claim per row.
+    code_cols : list of str
+        Columns with ICD codes. Missing codes and blank strings are skipped.
+    patient_col : str
+        Optional column with patient identifiers. If specified, comorbidities
+        are combined per patient.
+    version_col : str
+        Optional column with the ICD version (9 or 10) of each claim. If not
+        specified, every claim is assumed to be `icd_version`.
+    icd_version : int
+        Version of ICD codes when `version_col` is not specified.
+        Can be either 9 or 10.
+    mapping : str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser',
+        'charlson', 'custom'.
+    custom_map : dict or CompiledMapper
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+    errors : str
+        How to handle invalid codes. Can be one of 'raise', 'coerce',
+        'ignore'. See comorbidities().
+
+    Returns
+    -------
+    pd.DataFrame
+        Dataframe with one boolean column per comorbidity, indexed like
+        `claims`, or by patient if `patient_col` is specified.
+
+    Example
+    -------
+    >>> claims = pd.DataFrame({'patient_id': [1, 1, 2], 'dx1': ['4254', '0010', 'V427'],
+    ...                        'dx2': ['40403', None, None]})
+    >>> wide_comorbidity_matrix(claims, ['dx1', 'dx2'], mapping='charlson')
+    >>> wide_comorbidity_matrix(claims, ['dx1', 'dx2'], patient_col='patient_id', mapping='charlson')
+    """
+    _check_errors(errors)
+    masks = _claim_masks(claims, code_cols, version_col, icd_version, mapping, custom_map, errors)
+    if patient_col is None:
+        return pd.DataFrame(_masks_to_flags(masks, len(claims)), index=claims.index)
+
+    patients, patient_ids = pd.factorize(claims[patient_col], sort=True)
+    rows = patients >= 0
+    masks = [(categories, _reduce_masks(patients[rows], claim_masks[rows], len(patient_ids)))
+             for categories, claim_masks in masks]
+    return pd.DataFrame(_masks_to_flags(masks, len(patient_ids)),
+                        index=pd.Index(patient_ids, name=patient_col))
+
+def comorbidity_bits(mapping='elixhauser', icd_version=9, custom_map=None):
+    """
+    Gets the category-to-bit table used by bitmask outputs.
+
+    Bit ``i`` of a bitmask is set when the code belongs to the ``i``-th category
+    of the mapper, in the order the categories are listed in `comorbidity_mappers`
+    (or in `custom_map`).
+
+    Parameters
+    ----------
+    mapping : str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser', 
+        'charlson', 'custom'.
+    icd_version : int
+        Version of ICD. Can be either 9 or 10.
+    custom_map : dict or CompiledMapper
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+
+    Returns
+    -------
+    pd.DataFrame
+        Dataframe with columns `bit`, `value` and `comorbidity`.
+
+    Example
+    -------
+    >>> comorbidity_bits(mapping='charlson', icd_version=10)
+    """
+    _check_mapping(mapping)
+    mapper = _get_mapper(mapping, icd_version, custom_map)
+    bits = np.arange(len(mapper.categories))
+    bits_table = pd.DataFrame({'bit': bits,
+                               'value': np.left_shift(1, bits.astype(mapper.mask_dtype)),
+                               'comorbidity': mapper.categories})
+    return bits_table
+
+def decode_bitmask(bitmask, mapping='elixhauser', icd_version=9, custom_map=None):
+    """
+    Converts comorbidity bitmasks back into lists of comorbidities.
+
+    Parameters
+    ----------
+    bitmask : int, pd.Series or np.ndarray
+        Bitmask or bitmasks, as returned by comorbidities() with `as_bitmask=True`.
+    mapping : str
+        Type of comorbiditiy mapping used to build the bitmask.
+    icd_version : int
+        Version of ICD used to build the bitmask.
+    custom_map : dict or CompiledMapper
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+
+    Returns
+    -------
+    list, pd.Series or np.ndarray
+        Comorbidities of each bitmask, in mapper order.
+
+    Example
+    -------
+    >>> decode_bitmask(32776, mapping='charlson', icd_version=9)
+    """
+    _check_mapping(mapping)
+    mapper = _get_mapper(mapping, icd_version, custom_map)
+    if isinstance(bitmask, pd.Series):
+        return pd.Series(mapper.decode_masks(bitmask.to_numpy(dtype=np.uint64)), index=bitmask.index)
+    if isinstance(bitmask, np.ndarray):
+        return mapper.decode_masks(bitmask.astype(np.uint64))
+    return mapper.decode(int(bitmask))
+
+class CompiledMapper(object):
+    """
+    Custom comorbidity mapper that is validated and compiled once, and can then be
+    applied to any number of codes or claims tables.
+
+    Parameters
+    ----------
+    custom_map : dict
+        A customized mapper that defines one group or
+        multiple groups of ICD codes, as used by custom_comorbidities().
+        Code ranges such as 'I20-I25' are compiled into an interval index
+        searched with binary search, rather than expanded into prefixes.
+    icd_version : int
+        Version of ICD codes the mapper applies to. Can be either 9 or 10.
+
+    Attributes
+    ----------
+    mapper : dict
+        custom_map with duplicate prefixes, and prefixes that start with
+        another prefix of the same category, removed.
+    categories : tuple of str
+        Categories of the mapper. Category ``i`` is stored as bit ``i``.
+    index : PrefixIndex
+        Compiled prefix index of the mapper.
+
+    Example
+    -------
+    >>> stroke = CompiledMapper({'stroke': ['33', '430-438']}, icd_version=9)
+    >>> stroke.map_one('3318')
+    >>> stroke.map_many(['3318', '82320'])
+    """
+    def __init__(self, custom_map, icd_version=9):
+        _check_custom_map(custom_map)
+        if icd_version not in [9,10]:
+            raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+        self.icd_version = icd_version
+        self._report = []
+        self.mapper = minimize_mapper(custom_map, self._report)
+        self.index = PrefixIndex(self.mapper)
+        self.categories = self.index.categories
+        self._codes = None
+
+    def __repr__(self):
+        return f'CompiledMapper(categories={list(self.categories)}, icd_version={self.icd_version})'
+
+    def report(self):
+        """
+        Lists the entries of custom_map that were removed when compiling the mapper.
+        See mapper_report().
+        """
+        return _report_table(self._report)
+
+    def map_one(self, icd_code):
+        """
+        Applies the mapper to one ICD code.
+
+        Parameters
+        ----------
+        icd_code : str
+            ICD code
+
+        Returns
+        -------
+        list
+            Custom comorbidities for the ICD code of interest.
+        """
+        return custom_comorbidities(icd_code, self.icd_version, self)
+
+    def map_many(self, icd_codes, as_bitmask=False, errors='raise'):
+        """
+        Applies the mapper to many ICD codes. See comorbidities() for parameters.
+
+        Returns
+        -------
+        pd.DataFrame
+            Dataframe with columns `icd_code`, `description`, `custom_comorbidity`.
+        """
+        return comorbidities(icd_codes, icd_version=self.icd_version, mapping='custom',
+                             custom_map=self, as_bitmask=as_bitmask, errors=errors)
+
+    def patient_matrix(self, claims, patient_col='patient_id', code_col='icd_code', sparse=False,
+                       errors='raise'):
+        """
+        Builds a patient-level matrix of the mapper's comorbidities.
+        See comorbidity_matrix() for parameters.
+
+        Returns
+        -------
+        pd.DataFrame or tuple
+            Dataframe indexed by patient with one boolean column per comorbidity.
+        """
+        return comorbidity_matrix(claims, patient_col=patient_col, code_col=code_col,
+                                  icd_version=self.icd_version, mapping='custom',
+                                  custom_map=self, sparse=sparse, errors=errors)
+
+    def codes_for(self, category):
+        """
+        Lists the ICD codes of the vocabulary of the mapper's ICD version that
+        belong to a category. The reverse index is computed on the first call.
+
+        Parameters
+        ----------
+        category : str
+            Category of the mapper.
+
+        Returns
+        -------
+        list of str
+            Sorted ICD codes.
+        """
+        if self._codes is None:
+            self._codes = self.index.expand(icd9_codes if self.icd_version == 9 else icd10_codes)
+        if category not in self._codes:
+            raise ValueError(f"{category} is not a category of this mapper.")
+        return self._codes[category].tolist()
+
+def codes_for(category, icd_version=9, mapping='elixhauser', custom_map=None):
+    """
+    Lists the ICD codes that belong to a comorbidity category, among the codes of
+    the ICD-9CM or ICD-10 vocabulary. The reverse index of the Elixhauser and
+    Charlson mappers is built once from their lookup tables, so that lists of codes
+    can be used to filter claims in a database, e.g. with ``IN (...)``.
+
+    Parameters
+    ----------
+    category : str
+        Comorbidity category, as returned by comorbidities().
+    icd_version : int
+        Version of ICD codes. Can be either 9 or 10.
+    mapping : str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser',
+        'charlson', 'custom'.
+    custom_map : dict or CompiledMapper
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+
+    Returns
+    -------
+    list of str
+        Sorted ICD codes, without punctuation.
+
+    Example
+    -------
+    >>> codes_for('congestive heart failure', icd_version=10, mapping='charlson')
+    """
+    _check_mapping(mapping)
+    if icd_version not in [9,10]:
+        raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+    if mapping == 'custom':
+        if isinstance(custom_map, CompiledMapper) and custom_map.icd_version == icd_version:
+            return custom_map.codes_for(category)
+        index = _get_mapper('custom', icd_version, custom_map)
+        codes = index.expand(icd9_codes if icd_version == 9 else icd10_codes)
+    else:
+        codes = _get_mapper(mapping, icd_version).expand()
+    if category not in codes:
+        raise ValueError(f"{category} is not a {mapping} comorbidity.")
+    return codes[category].tolist()
+
+def _report_table(report):
+    return pd.DataFrame(report, columns=['comorbidity', 'entry', 'reason', 'kept'])
+
+def mapper_report(mapping='elixhauser', icd_version=9, custom_map=None):
+    """
+    Lists the mapper entries that are removed when a mapper is compiled.
+
+    Mappers are compiled with duplicate entries, and prefixes that start with a
+    shorter prefix of the same comorbidity, removed. This does not change which
+    codes match, but reduces the work done on each lookup.
+
+    Parameters
+    ----------
+    mapping : str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser', 
+        'charlson', 'custom'.
+    icd_version : int
+        Version of ICD. Can be either 9 or 10.
+    custom_map : dict
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+
+    Returns
+    -------
+    pd.DataFrame
+        Dataframe with columns `comorbidity`, `entry`, `reason` and `kept`, where
+        `reason` is 'duplicate' or 'subsumed' and `kept` is the entry that still
+        matches the codes of the removed one.
+
+    Example
+    -------
+    >>> mapper_report(mapping='charlson', icd_version=10)
+    """
+    _check_mapping(mapping)
+    if mapping == 'custom':
+        if isinstance(custom_map, CompiledMapper):
+            return custom_map.report()
+        _check_custom_map(custom_map)
+        mapper = custom_map
+    else:
+        if icd_version not in [9,10]:
+            raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+        mapper = comorbidity_mappers[f'{mapping}_{icd_version}']
+    report = []
+    minimize_mapper(mapper, report)
+    return _report_table(report)
+
+def validate_icd_codes(icd_codes, icd_version=9, return_reasons=False):
+    """
+    Checks which codes are recognized ICD codes, without raising errors.
+
+    Parameters
+    ----------
+    icd_codes : list, pd.Series or np.ndarray
+        ICD codes
+    icd_version : int
+        Version of ICD codes. Can be either 9 or 10.
+    return_reasons : bool
+        If True, also returns the reason each code is invalid.
+
+    Returns
+    -------
+    np.ndarray or pd.Series
+        Boolean mask that is True for valid codes. If `icd_codes` is a
+        pd.Series, a pd.Series with the same index. If `return_reasons` is
+        True, returns a tuple ``(mask, reasons)`` where reasons are one of
+        'valid', 'missing', 'not_string' or 'unknown'.
+
+    Example
+    -------
+    >>> validate_icd_codes(['4254', '42.54', None], return_reasons=True)
+    """
+    if icd_version not in [9,10]:
+        raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+    codes = icd_codes if isinstance(icd_codes, pd.Series) else pd.Series(icd_codes, dtype=object)
+    inverse, uniques = pd.factorize(codes, use_na_sentinel=False)
+    uniques = pd.Series(uniques, dtype=object)
+    reasons = _icd_code_reasons(uniques, _format_icd_codes(uniques, icd_version), icd_version)[inverse]
+    valid = reasons == 'valid'
+    if isinstance(icd_codes, pd.Series):
+        valid = pd.Series(valid, index=codes.index)
+        reasons = pd.Series(reasons, index=codes.index)
+    if return_reasons:
+        return valid, reasons
+    return valid
@@ -0,0 +1,130 @@
+"""
+Lookback
+========
+Risk adjustment uses the comorbidities recorded in a window before an index event,
+such as the 365 days before an admission. The function in this module finds them
+without joining events to claims: claims with at least one comorbidity are sorted
+by patient and date, the window of each event is located with a binary search,
+and a running count of each comorbidity tells whether it occurs in the window.
+Memory use grows with the number of claims and events, not with their product.
+"""
+
+import numpy as np
+import pandas as pd
+
+from medcodes.diagnoses.comorbidities import _check_errors, _claim_masks, _masks_to_flags
+
+
+def _to_days(dates):
+    """Converts dates to a number of days since the epoch, and returns a mask of missing dates."""
+    days = pd.to_datetime(pd.Series(dates), errors='coerce').to_numpy().astype('datetime64[D]')
+    missing = np.isnat(days)
+    return days.astype(np.int64), missing
+
+def _window_bounds(claim_keys, event_keys, window, include_event_date):
+    """Locates the claims in the lookback window of each event, as a range of sorted claims."""
+    lower = np.searchsorted(claim_keys, event_keys - window, side='left')
+    upper = np.searchsorted(claim_keys, event_keys, side='right' if include_event_date else 'left')
+    return lower, upper
+
+def lookback_comorbidities(claims, events, window=365, patient_col='patient_id', code_col='icd_code',
+                           date_col='date', event_date_col=None, version_col=None, icd_version=9,
+                           mapping='elixhauser', custom_map=None, include_event_date=False,
+                           errors='raise'):
+    """
+    Identifies the comorbidities of each index event from the claims of the same
+    patient in a lookback window before the event.
+
+    Parameters
+    ----------
+    claims : pd.DataFrame
+        Claims table with one ICD code and one date per row. Missing codes
+        are skipped.
+    events : pd.DataFrame
+        Index events, such as admissions, with one patient and one date per row.
+    window : int
+        Length of the lookback window in days. Claims dated from `window` days
+        before the event up to the day before the event are used.
+    patient_col : str
+        Column with patient identifiers, in both claims and events.
+    code_col : str
+        Column of claims with ICD codes.
+    date_col : str
+        Column of claims with service dates.
+    event_date_col : str
+        Column of events with event dates. Defaults to `date_col`.
+    version_col : str
+        Optional column of claims with the ICD version (9 or 10) of each row.
+        If not specified, every row is assumed to be `icd_version`.
+    icd_version : int
+        Version of ICD codes when `version_col` is not specified.
+        Can be either 9 or 10.
+    mapping : str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser',
+        'charlson', 'custom'.
+    custom_map : dict or CompiledMapper
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+    include_event_date : bool
+        If True, claims dated on the day of the event are also used.
+    errors : str
+        How to handle invalid codes. Can be one of 'raise', 'coerce',
+        'ignore'. See comorbidities().
+
+    Returns
+    -------
+    pd.DataFrame
+        Dataframe indexed like `events` with one boolean column per comorbidity.
+        Events without a date or without claims get no comorbidities.
+
+    Example
+    -------
+    >>> claims = pd.DataFrame({'patient_id': [1, 1, 2], 'icd_code': ['4254', '40403', '4254'],
+    ...                        'date': ['2014-01-10', '2014-11-02', '2013-06-01']})
+    >>> events = pd.DataFrame({'patient_id': [1, 2], 'date': ['2014-12-01', '2014-12-01']})
+    >>> lookback_comorbidities(claims, events, window=365, mapping='charlson')
+    """
+    if not isinstance(window, (int, np.integer)) or window < 0:
+        raise ValueError("window must be a non-negative number of days.")
+    _check_errors(errors)
+    event_date_col = event_date_col or date_col
+    masks = _claim_masks(claims, [code_col], version_col, icd_version, mapping, custom_map, errors)
+
+    has_comorbidity = np.zeros(len(claims), dtype=bool)
+    for _, claim_masks in masks:
+        has_comorbidity |= claim_masks != 0
+    claim_days, missing = _to_days(claims[date_col].to_numpy())
+    claim_patients, patient_ids = pd.factorize(claims[patient_col])
+    rows = np.flatnonzero(has_comorbidity & ~missing & (claim_patients >= 0))
+
+    event_days, event_missing = _to_days(events[event_date_col].to_numpy())
+    event_patients = pd.Index(patient_ids).get_indexer(events[patient_col])
+    event_rows = ~event_missing & (event_patients >= 0)
+
+    # Claims and events are keyed by patient and day, so that sorting the keys sorts
+    # claims by patient then date, and the window of an event is a range of keys.
+    first_day = min(claim_days[rows].min(initial=0), event_days[event_rows].min(initial=0) - window)
+    last_day = max(claim_days[rows].max(initial=0), event_days[event_rows].max(initial=0))
+    span = last_day - first_day + window + 2
+    claim_keys = claim_patients[rows] * span + (claim_days[rows] - first_day)
+    order = np.argsort(claim_keys, kind='stable')
+    claim_keys = claim_keys[order]
+    event_keys = event_patients * span + (event_days - first_day)
+
+    lower, upper = _window_bounds(claim_keys, event_keys, window, include_event_date)
+    lower[~event_rows] = 0
+    upper[~event_rows] = 0
+
+    count_dtype = np.int32 if len(claim_keys) < np.iinfo(np.int32).max else np.int64
+    event_masks = []
+    for categories, claim_masks in masks:
+        sorted_masks = claim_masks[rows][order]
+        in_window = np.zeros(len(events), dtype=np.uint64)
+        for bit in range(len(categories)):
+            has_bit = (sorted_masks >> np.uint64(bit) & np.uint64(1)).astype(count_dtype)
+            if not has_bit.any():
+                continue
+            counts = np.zeros(len(has_bit) + 1, dtype=count_dtype)
+            np.cumsum(has_bit, out=counts[1:])
+            in_window |= (counts[upper] > counts[lower]).astype(np.uint64) << np.uint64(bit)
+        event_masks.append((categories, in_window))
+    return pd.DataFrame(_masks_to_flags(event_masks, len(events)), index=events.index)
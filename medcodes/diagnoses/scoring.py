@@ -0,0 +1,112 @@
+"""
+Scoring
+=======
+Comorbidity indices summarize a patient's comorbidities into a single score. The
+scoring functions in this module take a patient-level comorbidity matrix, such as
+the output of comorbidity_matrix(), and compute the Charlson Comorbidity Index or
+the Elixhauser (van Walraven) score for every patient at once.
+"""
+
+import numpy as np
+import pandas as pd
+
+from medcodes.diagnoses._mappers import comorbidity_weights, comorbidity_hierarchies, comorbidity_aliases
+
+
+def _check_matrix(matrix):
+    """Checks that matrix is a dataframe of comorbidity flags."""
+    if not isinstance(matrix, pd.DataFrame):
+        raise TypeError("matrix must be a pandas DataFrame.")
+
+def _score(matrix, mapping, hierarchy):
+    """
+    Computes the weighted sum of comorbidity flags for each row of matrix.
+
+    ICD-9 categories that the ICD-10 mapper names differently are folded into
+    their ICD-10 name before weighting, so that matrices built from mixed ICD
+    versions score each condition once.
+    """
+    _check_matrix(matrix)
+    aliases = comorbidity_aliases[mapping]
+    weights = {**{aliases.get(c, c): w for c, w in comorbidity_weights[f'{mapping}_9'].items()},
+               **comorbidity_weights[f'{mapping}_10']}
+    unknown = [c for c in matrix.columns if aliases.get(c, c) not in weights]
+    if unknown:
+        raise ValueError(f"{unknown} are not {mapping} comorbidities.")
+
+    flags = {}
+    for c in matrix.columns:
+        category = aliases.get(c, c)
+        has_category = matrix[c].to_numpy(dtype=bool)
+        flags[category] = flags[category] | has_category if category in flags else has_category
+    if hierarchy:
+        rules = comorbidity_hierarchies[f'{mapping}_9'] + comorbidity_hierarchies[f'{mapping}_10']
+        rules = dict.fromkeys((aliases.get(s, s), aliases.get(i, i)) for s, i in rules)
+        for superior, inferior in rules:
+            if superior in flags and inferior in flags:
+                flags[inferior] = flags[inferior] & ~flags[superior]
+
+    scores = np.zeros(len(matrix), dtype=np.int32)
+    for category, has_category in flags.items():
+        if weights[category]:
+            scores += weights[category] * has_category
+    return scores
+
+def charlson_index(matrix, hierarchy=True):
+    """
+    Computes the Charlson Comorbidity Index of each patient.
+    Uses the weights defined by Charlson et al. [1].
+
+    Parameters
+    ----------
+    matrix : pd.DataFrame
+        Patient-level matrix with one boolean column per Charlson comorbidity,
+        as returned by comorbidity_matrix(mapping='charlson').
+    hierarchy : bool
+        If True, only the most severe form of a comorbidity is scored: diabetes
+        with chronic complication supersedes diabetes without, metastatic solid
+        tumor supersedes malignancy and moderate or severe liver disease
+        supersedes mild liver disease.
+
+    Returns
+    -------
+    pd.Series
+        Charlson Comorbidity Index of each patient.
+
+    References
+    ----------
+    [1] Charlson ME, Pompei P, Ales KL, MacKenzie CR. A new method of classifying
+    prognostic comorbidity in longitudinal studies: development and validation.
+    J Chronic Dis. 1987; 40(5): 373-83.
+    """
+    scores = _score(matrix, 'charlson', hierarchy)
+    return pd.Series(scores, index=matrix.index, name='charlson_index')
+
+def elixhauser_index(matrix, hierarchy=True):
+    """
+    Computes the Elixhauser comorbidity score of each patient.
+    Uses the weights defined by van Walraven et al. [1].
+
+    Parameters
+    ----------
+    matrix : pd.DataFrame
+        Patient-level matrix with one boolean column per Elixhauser comorbidity,
+        as returned by comorbidity_matrix(mapping='elixhauser').
+    hierarchy : bool
+        If True, only the most severe form of a comorbidity is scored: complicated
+        diabetes and hypertension supersede their uncomplicated forms and metastatic
+        cancer supersedes solid tumor without metastasis.
+
+    Returns
+    -------
+    pd.Series
+        van Walraven Elixhauser score of each patient.
+
+    References
+    ----------
+    [1] van Walraven C, Austin PC, Jennings A, et al. A modification of the Elixhauser
+    comorbidity measures into a point system for hospital death using administrative
+    data. Med Care. 2009 Jun; 47(6): 626-33.
+    """
+    scores = _score(matrix, 'elixhauser', hierarchy)
+    return pd.Series(scores, index=matrix.index, name='elixhauser_index')
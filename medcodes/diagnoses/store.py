@@ -0,0 +1,178 @@
+"""
+Store
+=====
+Comorbidity profiles of a patient population only change where new claims arrive.
+ComorbidityStore keeps the state of each patient as PatientAggregates, a bitmask of
+the comorbidities seen so far, the dates of their first and last claims and their
+number of claims, and merges in the aggregates of new claims only, so that a nightly
+refresh costs as much as the new claims rather than the full claims history. The
+store is saved to and loaded from a ``.npz`` file.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from medcodes.diagnoses.aggregates import PatientAggregates
+from medcodes.diagnoses.comorbidities import CompiledMapper, _check_mapping, _get_mapper
+
+
+class ComorbidityStore(object):
+    """
+    Persistent per-patient comorbidity state that is updated incrementally with new claims.
+
+    Parameters
+    ----------
+    mapping : str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser',
+        'charlson', 'custom'.
+    icd_version : int
+        Version of ICD codes of claims when no version column is given
+        to update(). Can be either 9 or 10.
+    custom_map : dict or CompiledMapper
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+    patient_col : str
+        Column of claims with patient identifiers.
+    code_col : str
+        Column of claims with ICD codes.
+    date_col : str
+        Column of claims with service dates.
+
+    Attributes
+    ----------
+    aggregates : PatientAggregates
+        Comorbidities, first and last claim dates and claim counts of each
+        patient. For 'elixhauser' and 'charlson', categories are the union of
+        the categories of the ICD-9 and ICD-10 mappers.
+
+    Example
+    -------
+    >>> store = ComorbidityStore(mapping='charlson')
+    >>> store.update(claims_of_the_day)
+    >>> store.query([1, 2])
+    >>> store.save('charlson_store.npz')
+    >>> store = ComorbidityStore.load('charlson_store.npz')
+    """
+    def __init__(self, mapping='elixhauser', icd_version=9, custom_map=None,
+                 patient_col='patient_id', code_col='icd_code', date_col='date'):
+        _check_mapping(mapping)
+        if icd_version not in [9,10]:
+            raise ValueError("icd_version must be either 9 or 10. Default is set to 9.")
+        if mapping == 'custom' and not isinstance(custom_map, CompiledMapper):
+            custom_map = CompiledMapper(custom_map, icd_version)
+        self.mapping = mapping
+        self.icd_version = icd_version
+        self.custom_map = custom_map
+        self.patient_col = patient_col
+        self.code_col = code_col
+        self.date_col = date_col
+        if mapping == 'custom':
+            categories = custom_map.categories
+        else:
+            categories = dict.fromkeys(c for version in [9, 10]
+                                       for c in _get_mapper(mapping, version).categories)
+        self.aggregates = PatientAggregates.empty(list(categories))
+
+    def __repr__(self):
+        return f'ComorbidityStore(mapping={self.mapping!r}, patients={len(self)})'
+
+    def __len__(self):
+        return len(self.aggregates)
+
+    def update(self, claims, version_col=None, errors='raise'):
+        """
+        Adds the comorbidities, dates and counts of new claims to the store. Only
+        the new claims are mapped; their aggregates are then merged into the store.
+
+        Parameters
+        ----------
+        claims : pd.DataFrame
+            New claims, with the patient, code and date columns of the store.
+            Missing codes are skipped.
+        version_col : str
+            Optional column with the ICD version (9 or 10) of each row. If not
+            specified, every row is assumed to be the store's `icd_version`.
+        errors : str
+            How to handle invalid codes. Can be one of 'raise', 'coerce',
+            'ignore'. See comorbidities().
+
+        Returns
+        -------
+        ComorbidityStore
+            The updated store.
+        """
+        new = PatientAggregates.from_claims(claims, self.patient_col, self.code_col, self.date_col,
+                                            version_col, self.icd_version, self.mapping,
+                                            self.custom_map, errors)
+        return self.merge(new)
+
+    def merge(self, aggregates):
+        """
+        Merges aggregates computed elsewhere, for example on another partition of
+        the new claims, into the store.
+
+        Parameters
+        ----------
+        aggregates : PatientAggregates
+
+        Returns
+        -------
+        ComorbidityStore
+            The updated store.
+        """
+        self.aggregates = self.aggregates.merge(aggregates)
+        return self
+
+    def query(self, patient_ids=None):
+        """
+        Gets the comorbidities, dates and claim counts of patients.
+        See PatientAggregates.to_frame().
+
+        Parameters
+        ----------
+        patient_ids : list, pd.Series or np.ndarray
+            Patients to query. If not specified, returns every patient in the store.
+
+        Returns
+        -------
+        pd.DataFrame
+            Dataframe indexed by patient with one boolean column per comorbidity
+            and `first_seen`, `last_seen` and `count` columns.
+        """
+        return self.aggregates.to_frame(patient_ids).rename_axis(self.patient_col)
+
+    def save(self, path):
+        """
+        Saves the store to a ``.npz`` file. The file is replaced atomically, so that
+        an interrupted save leaves the previous file intact.
+        """
+        config = {'mapping': self.mapping, 'icd_version': self.icd_version,
+                  'custom_map': self.custom_map.mapper if self.mapping == 'custom' else None,
+                  'patient_col': self.patient_col, 'code_col': self.code_col,
+                  'date_col': self.date_col}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, config=np.array(json.dumps(config)),
+                                    **self.aggregates._to_arrays())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a store saved with save().
+
+        Returns
+        -------
+        ComorbidityStore
+        """
+        with np.load(path, allow_pickle=False) as saved:
+            config = json.loads(str(saved['config']))
+            store = cls(**config)
+            store.aggregates = PatientAggregates._from_arrays(saved)
+        return store
@@ -0,0 +1,187 @@
+"""
+Streaming
+=========
+Claims extracts are often larger than memory. The functions in this module read
+CSV or Parquet files in chunks, apply a comorbidity mapping to each chunk and
+yield or write the results incrementally, so that memory use is bounded by the
+chunk size rather than the size of the file.
+
+Parquet support requires pyarrow.
+"""
+
+import os
+
+import pandas as pd
+
+from medcodes.diagnoses.comorbidities import (_check_errors, _check_mappings, _get_mapper,
+                                                _comorbidities_table)
+
+
+def _file_format(path):
+    """Infers the format of a file from its extension."""
+    name = str(path).lower()
+    if name.endswith(('.parquet', '.pq')):
+        return 'parquet'
+    if name.endswith(('.csv', '.csv.gz', '.csv.bz2', '.csv.zip', '.txt')):
+        return 'csv'
+    raise ValueError(f"Cannot infer the format of {path}. Use file_format='csv' or 'parquet'.")
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Reading and writing Parquet files requires pyarrow.")
+    return pyarrow
+
+def _read_chunks(path, columns, chunksize, file_format, code_col, dtype):
+    """Yields dataframes of at most chunksize rows with the given columns."""
+    if file_format == 'csv':
+        yield from pd.read_csv(path, usecols=columns, dtype={**dtype, code_col: str}, chunksize=chunksize)
+    else:
+        pyarrow = _import_pyarrow()
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+
+def _stream(path, code_col, icd_version, mappings, mappers, as_bitmask, errors, keep_cols,
+            chunksize, file_format, dtype):
+    """Yields the output of comorbidities() for each chunk of the file."""
+    columns = [code_col] + [c for c in keep_cols if c != code_col]
+    for chunk in _read_chunks(path, columns, chunksize, file_format, code_col, dtype):
+        codes = chunk[code_col].astype(object)
+        table = _comorbidities_table(codes, icd_version, mappings, mappers, as_bitmask, errors)
+        for c in keep_cols:
+            table[c] = chunk[c]
+        yield table
+
+def _parquet_schema(path, file_format, mappings, mappers, as_bitmask, keep_cols):
+    """
+    Builds the Parquet schema of the output columns that are known before reading,
+    so that chunks without matches or with only missing values keep the same types.
+    Types of `keep_cols` are taken from the schema of a Parquet input file.
+    """
+    pyarrow = _import_pyarrow()
+    fields = {'icd_code': pyarrow.string(), 'description': pyarrow.string()}
+    for mapping, mapper in zip(mappings, mappers):
+        if as_bitmask:
+            comorbidity_type = pyarrow.from_numpy_dtype(mapper.mask_dtype)
+        else:
+            comorbidity_type = pyarrow.list_(pyarrow.string())
+        fields[f'{mapping.lower()}_comorbidity'] = comorbidity_type
+    if file_format == 'parquet':
+        file_schema = pyarrow.parquet.ParquetFile(path).schema_arrow
+        for c in keep_cols:
+            fields[c] = file_schema.field(c).type
+    return pyarrow.schema(list(fields.items()))
+
+def _write(chunks, output, file_format, schema=None):
+    """
+    Writes chunks to output as they are produced. For Parquet, columns of `schema`
+    keep its types; other columns are typed from the first chunk, with columns that
+    are entirely missing written as strings.
+    """
+    if file_format == 'csv':
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(output, mode='w' if header else 'a', header=header, index=False)
+            header = False
+        return
+
+    pyarrow = _import_pyarrow()
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                inferred = pyarrow.Schema.from_pandas(chunk, preserve_index=False)
+                fields = []
+                for field in inferred:
+                    if schema is not None and field.name in schema.names:
+                        field = schema.field(field.name)
+                    elif pyarrow.types.is_null(field.type):
+                        field = field.with_type(pyarrow.string())
+                    fields.append(field)
+                writer = pyarrow.parquet.ParquetWriter(output, pyarrow.schema(fields))
+            table = pyarrow.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+def comorbidities_from_file(path, code_col='icd_code', icd_version=9, mapping='elixhauser',
+                            custom_map=None, as_bitmask=False, keep_cols=None, chunksize=1000000,
+                            output=None, file_format=None, errors='raise', dtype=None):
+    """
+    Applies a comorbidity mapping to the ICD codes of a CSV or Parquet file, chunk by chunk.
+
+    Parameters
+    ----------
+    path : str
+        Path to a CSV or Parquet file with one ICD code per row.
+    code_col : str
+        Column with ICD codes.
+    icd_version : int
+        Version of ICD codes. Can be either 9 or 10.
+    mapping : str or list of str
+        Type of comorbiditiy mapping. Can be one of 'elixhauser',
+        'charlson', 'custom'. If a list, one comorbidity column is added per
+        mapping.
+    custom_map : dict
+        Custom mapper dictionary. Used when mapping is set to 'custom'.
+    as_bitmask : bool
+        If True, comorbidities are encoded as an unsigned integer bitmask.
+        Recommended when writing to CSV.
+    keep_cols : list of str
+        Columns of the input file to carry over to the output, such as
+        patient identifiers or dates.
+    chunksize : int
+        Number of rows read and processed at a time.
+    output : str
+        Path of the file to write results to, as CSV or Parquet depending on
+        its extension. If not specified, results are yielded chunk by chunk.
+    file_format : str
+        Format of the input file, 'csv' or 'parquet'. Inferred from the
+        extension of `path` if not specified.
+    errors : str
+        How to handle invalid codes. Can be one of 'raise', 'coerce',
+        'ignore'. See comorbidities().
+    dtype : dict
+        Types of `keep_cols` when reading a CSV file, passed to pd.read_csv().
+        When writing a CSV file to Parquet, `keep_cols` without a type are read
+        as strings, so that every chunk is written with the same types.
+
+    Returns
+    -------
+    generator of pd.DataFrame or str
+        If `output` is not specified, a generator of dataframes with the same
+        columns as comorbidities(), plus `keep_cols`. Otherwise, `output`.
+
+    Example
+    -------
+    >>> for chunk in comorbidities_from_file('claims.csv', keep_cols=['patient_id']):
+    ...     print(chunk.shape)
+    """
+    mappings = _check_mappings(mapping)
+    if file_format is None:
+        file_format = _file_format(path)
+    if file_format not in ['csv', 'parquet']:
+        raise ValueError("file_format must be either 'csv' or 'parquet'.")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} does not exist.")
+
+    _check_errors(errors)
+    mappers = [_get_mapper(m, icd_version, custom_map) for m in mappings]
+    keep_cols = keep_cols or []
+    output_format = None if output is None else _file_format(output)
+    dtype = dict(dtype or {})
+    if file_format == 'csv' and output_format == 'parquet':
+        dtype = {**{c: str for c in keep_cols}, **dtype}
+    chunks = _stream(path, code_col, icd_version, mappings, mappers, as_bitmask, errors,
+                     keep_cols, chunksize, file_format, dtype)
+    if output is None:
+        return chunks
+    schema = None
+    if output_format == 'parquet':
+        schema = _parquet_schema(path, file_format, mappings, mappers, as_bitmask, keep_cols)
+    _write(chunks, output, output_format, schema)
+    return output
@@ -12,9 +12,11 @@ setup(
 
     packages=find_packages(),
 
-    install_requires=['pandas'],
+    python_requires='>=3.8',
+
+    install_requires=['numpy', 'pandas>=1.5'],
 
     classifiers=[
-        'Programming Language :: Python :: 3.6'
+        'Programming Language :: Python :: 3.8'
     ],
 )
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""
+Fixtures
+========
+"""
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """
+    Caches lookup tables in a temporary directory instead of ~/.cache/medcodes.
+    """
+    cache = tmp_path / 'cache'
+    monkeypatch.setenv('MEDCODES_CACHE_DIR', str(cache))
+    return cache
@@ -0,0 +1,89 @@
+"""
+Aggregates
+==========
+"""
+
+import functools
+import pytest
+import numpy as np
+import pandas as pd
+from medcodes.diagnoses import PatientAggregates, ComorbidityStats, comorbidities
+
+
+def _claims():
+    return pd.DataFrame({'patient_id': [1, 1, 2, 2, 3, 1],
+                         'icd_code': ['4254', '40403', '4254', '5715', '0010', '3318'],
+                         'date': pd.to_datetime(['2014-01-02', '2014-01-01', '2014-01-02',
+                                                 '2014-01-03', '2014-01-03', '2014-02-01'])})
+
+def test_merge_partitions():
+    """
+    Test that merging the aggregates of partitions, in any order,
+    gives the aggregates of the whole claims table.
+    """
+    claims = _claims()
+    expected = PatientAggregates.from_claims(claims, mapping='charlson').to_frame().sort_index()
+    parts = [PatientAggregates.from_claims(claims.iloc[rows], mapping='charlson')
+             for rows in [[0, 4], [1, 2], [3, 5]]]
+    for order in [[0, 1, 2], [2, 0, 1], [1, 2, 0]]:
+        merged = functools.reduce(PatientAggregates.merge, [parts[i] for i in order])
+        assert(merged.to_frame().sort_index().equals(expected))
+    assert(list(expected['count']) == [3, 2, 1])
+    assert(str(expected.loc[1, 'first_seen'].date()) == '2014-01-01')
+    assert(str(expected.loc[1, 'last_seen'].date()) == '2014-02-01')
+
+def test_merge_categories():
+    """
+    Test that merging aggregates with different categories uses
+    the union of categories.
+    """
+    claims = _claims()
+    heart = PatientAggregates.from_claims(claims, mapping='custom', custom_map={'heart': ['42']})
+    stroke = PatientAggregates.from_claims(claims, mapping='custom', custom_map={'stroke': ['33'], 'heart': ['40']})
+    merged = heart.merge(stroke).to_frame()
+    assert(merged.columns[:2].tolist() == ['heart', 'stroke'])
+    assert(list(merged['heart']) == [True, True, False])
+    assert(list(merged['stroke']) == [True, False, False])
+    assert(list(merged['count']) == [6, 4, 2])
+
+def test_to_bytes():
+    """
+    Test that aggregates survive serialization.
+    """
+    aggregates = PatientAggregates.from_claims(_claims().assign(patient_id=list('aabbca')))
+    restored = PatientAggregates.from_bytes(aggregates.to_bytes())
+    assert(restored.to_frame().equals(aggregates.to_frame()))
+    assert(isinstance(aggregates.to_bytes(), bytes))
+
+def test_stats_prevalence():
+    """
+    Test that ComorbidityStats fed in chunks counts each category
+    like comorbidities() and is the same when fed bitmasks.
+    """
+    icd_codes = ['4254', '40403', '4254', '5715', '0010', '3318', '40403']
+    stats = ComorbidityStats(mapping='charlson')
+    stats.update(icd_codes[:3]).update(icd_codes[3:])
+    expected = comorbidities(icd_codes, mapping='charlson')['charlson_comorbidity'].explode().value_counts()
+    prevalence = stats.prevalence()
+    assert(stats.n == 7)
+    assert(prevalence.loc[expected.index, 'count'].tolist() == expected.tolist())
+    assert(prevalence['count'].sum() == expected.sum())
+    assert(prevalence.loc['congestive heart failure', 'prevalence'] == 4 / 7)
+    masks = comorbidities(icd_codes, mapping='charlson', as_bitmask=True)['charlson_comorbidity']
+    from_masks = ComorbidityStats(mapping='charlson').update_masks(masks)
+    assert((from_masks.pair_counts == stats.pair_counts).all())
+
+def test_stats_cooccurrence():
+    """
+    Test that co-occurrence counts match a matrix product of flags,
+    and that accumulators can be merged.
+    """
+    custom_map = {'heart': ['42', '40'], 'kidney': ['40', '58'], 'liver': ['57']}
+    masks = np.array([0, 1, 3, 3, 2, 4, 5, 7], dtype=np.uint64)
+    flags = ((masks[:, None] >> np.arange(3, dtype=np.uint64)) & np.uint64(1)).astype(int)
+    stats = ComorbidityStats(mapping='custom', custom_map=custom_map).update_masks(masks[:3])
+    stats.merge(ComorbidityStats(mapping='custom', custom_map=custom_map).update_masks(masks[3:]))
+    assert((stats.cooccurrence().to_numpy() == flags.T @ flags).all())
+    assert(stats.cooccurrence(normalize=True).loc['heart', 'kidney'] == 3 / 8)
+    with pytest.raises(ValueError):
+        stats.merge(ComorbidityStats(mapping='charlson'))
@@ -4,8 +4,14 @@ Comorbidities
 """
 
 import pytest
+import numpy as np
 import pandas as pd
-from medcodes.diagnoses import elixhauser, charlson, custom_comorbidities, comorbidities
+import os
+from medcodes.diagnoses import elixhauser, charlson, custom_comorbidities, comorbidities, comorbidity_matrix, wide_comorbidity_matrix, comorbidity_bits, decode_bitmask, CompiledMapper, mapper_report, validate_icd_codes, infer_icd_version, codes_for
+from medcodes.diagnoses._lookup_table import load_lookup_tables
+from medcodes.diagnoses._prefix_index import PrefixIndex
+from medcodes.diagnoses._packed_codes import pack_codes, unpack_codes
+from medcodes.diagnoses.comorbidities import _format_icd_code, _format_icd_codes
 
 
 def test_elixhauser_output():
@@ -30,6 +36,22 @@ def test_charlson_output():
     output = charlson('39891')
     assert(isinstance(output, list))
 
+def test_charlson_matches_prefixes():
+    """
+    Test that charlson() returns every category with a
+    matching prefix, in mapper order.
+    """
+    assert(charlson('40403') == ['congestive heart failure', 'renal disease'])
+    assert(charlson('I252', icd_version=10) == ['myocardial infarction'])
+    assert(charlson('0010') == [])
+
+def test_elixhauser_matches_prefixes():
+    """
+    Test that elixhauser() returns every category with a
+    matching prefix, in mapper order.
+    """
+    assert(elixhauser('4255') == ['alcohol abuse', 'congestive heart failure'])
+
 def test_comorbidities_output():
     """
     Test that comorbidities() outputs a dataframe. 
@@ -41,6 +63,57 @@ def test_comorbidities_output():
     output = comorbidities(icd_codes, icd_version=9, mapping='custom', custom_map=custom_map)
     assert(isinstance(output, pd.DataFrame))
 
+def test_comorbidities_series_input():
+    """
+    Test that comorbidities() accepts a pd.Series or np.ndarray,
+    preserves the Series index and matches charlson() row by row.
+    """
+    icd_codes = ['40403', '0010', '4254', '40403']
+    expected = [charlson(c) for c in icd_codes]
+    output = comorbidities(pd.Series(icd_codes, index=[5, 6, 7, 8]), mapping='charlson')
+    assert(list(output.index) == [5, 6, 7, 8])
+    assert(list(output['charlson_comorbidity']) == expected)
+    output = comorbidities(np.array(icd_codes), mapping='charlson')
+    assert(list(output['charlson_comorbidity']) == expected)
+
+def test_comorbidities_repeated_codes():
+    """
+    Test that comorbidities() broadcasts results of repeated
+    codes back to every row, in input order.
+    """
+    icd_codes = ['4254', '40403'] * 3
+    output = comorbidities(icd_codes, mapping='elixhauser')
+    assert(list(output['icd_code']) == icd_codes)
+    assert(list(output['elixhauser_comorbidity']) == [elixhauser(c) for c in icd_codes])
+
+def test_comorbidities_unknown_code_error():
+    """
+    Test that comorbidities() raises a ValueError on an unknown code.
+    """
+    with pytest.raises(ValueError):
+        comorbidities(pd.Series(['40403', 'XYZ']))
+
+def test_comorbidities_bitmask_output():
+    """
+    Test that comorbidities() with as_bitmask=True returns a uint32
+    column that decode_bitmask() converts back to category lists.
+    """
+    icd_codes = ['40403', '0010', '4254']
+    output = comorbidities(icd_codes, mapping='charlson', as_bitmask=True)
+    assert(output['charlson_comorbidity'].dtype == np.uint32)
+    decoded = decode_bitmask(output['charlson_comorbidity'], mapping='charlson')
+    assert(list(decoded) == [charlson(c) for c in icd_codes])
+
+def test_comorbidity_bits_table():
+    """
+    Test that comorbidity_bits() lists every category of the
+    mapper with its bit position.
+    """
+    bits = comorbidity_bits(mapping='elixhauser', icd_version=9)
+    assert(len(bits) == 31)
+    assert(list(bits['value'][:3]) == [1, 2, 4])
+    assert(decode_bitmask(int(bits['value'][3])) == [bits['comorbidity'][3]])
+
 def test_comorbidities_custom_map_schema_error():
     """
     Test that comorbidities() raises a TypeError if custom_map
@@ -65,4 +138,397 @@ def test_comorbidities_custom_map_type_error():
     }
     with pytest.raises(TypeError):
         comorbidities(icd_codes, icd_version=9, mapping='custom', custom_map='123')
-  
\ No newline at end of file
+  
+def test_comorbidity_matrix_output():
+    """
+    Test that comorbidity_matrix() returns one row per patient
+    and one boolean column per category.
+    """
+    claims = pd.DataFrame({
+        'patient_id': [2, 1, 1, 3],
+        'icd_code': ['4254', '40403', '0010', '0010']
+    })
+    output = comorbidity_matrix(claims, mapping='charlson')
+    assert(list(output.index) == [1, 2, 3])
+    assert(output.shape[1] == 17)
+    assert(output.loc[1, 'congestive heart failure'])
+    assert(output.loc[1, 'renal disease'])
+    assert(output.loc[2, 'congestive heart failure'])
+    assert(not output.loc[2, 'renal disease'])
+    assert(not output.loc[3].any())
+
+def test_comorbidity_matrix_version_col():
+    """
+    Test that comorbidity_matrix() applies the mapper of each
+    row's ICD version.
+    """
+    claims = pd.DataFrame({
+        'patient_id': [1, 1],
+        'icd_code': ['4254', 'I252'],
+        'icd_version': [9, 10]
+    })
+    output = comorbidity_matrix(claims, version_col='icd_version', mapping='charlson')
+    assert(output.loc[1, 'congestive heart failure'])
+    assert(output.loc[1, 'myocardial infarction'])
+
+def test_comorbidity_matrix_version_col_error():
+    """
+    Test that comorbidity_matrix() and wide_comorbidity_matrix() raise a
+    ValueError when a row's ICD version is missing or not 9 or 10.
+    """
+    for version in [np.nan, 11]:
+        claims = pd.DataFrame({
+            'patient_id': [1, 2],
+            'icd_code': ['4254', '4254'],
+            'icd_version': [9, version]
+        })
+        with pytest.raises(ValueError):
+            comorbidity_matrix(claims, version_col='icd_version')
+        with pytest.raises(ValueError):
+            wide_comorbidity_matrix(claims, ['icd_code'], version_col='icd_version')
+
+def test_comorbidity_matrix_sparse_coo():
+    """
+    Test that comorbidity_matrix(sparse='coo') returns the positions
+    of the True flags of the dense matrix.
+    """
+    claims = pd.DataFrame({
+        'patient_id': [2, 1, 1, 3],
+        'icd_code': ['4254', '40403', '0010', '0010']
+    })
+    dense = comorbidity_matrix(claims, mapping='charlson')
+    (rows, cols), patient_ids, categories = comorbidity_matrix(claims, mapping='charlson', sparse='coo')
+    assert(list(patient_ids) == list(dense.index))
+    assert(categories == list(dense.columns))
+    assert(np.array_equal(np.c_[rows, cols], np.argwhere(dense.to_numpy())))
+
+def test_comorbidity_matrix_sparse_csr():
+    """
+    Test that comorbidity_matrix(sparse='csr') matches the dense matrix.
+    """
+    pytest.importorskip('scipy')
+    claims = pd.DataFrame({
+        'patient_id': [2, 1, 1, 3],
+        'icd_code': ['4254', '40403', '0010', '0010']
+    })
+    dense = comorbidity_matrix(claims, mapping='charlson')
+    matrix, _, _ = comorbidity_matrix(claims, mapping='charlson', sparse='csr')
+    assert(np.array_equal(matrix.toarray(), dense.to_numpy()))
+
+def test_lookup_tables_cache(tmp_path, monkeypatch):
+    """
+    Test that load_lookup_tables() writes a cache file on the first
+    call, loads the same tables from it afterwards and matches the
+    prefix trie.
+    """
+    monkeypatch.setenv('MEDCODES_CACHE_DIR', str(tmp_path))
+    mappers = {'stroke_9': {'stroke': ['33'], 'heart': ['4254', '40403']}}
+    vocabularies = {'stroke_9': ['3318', '4254', '40403', '0010']}
+    tables = load_lookup_tables(mappers, vocabularies)
+    assert(len(os.listdir(tmp_path)) == 1)
+    assert(load_lookup_tables(mappers, vocabularies) == tables)
+    index = PrefixIndex(mappers['stroke_9'])
+    assert(tables['stroke_9'] == {c: index.match_mask(c) for c in vocabularies['stroke_9']})
+
+def test_lookup_tables_corrupt_cache(tmp_path, monkeypatch):
+    """
+    Test that load_lookup_tables() rebuilds a truncated cache file
+    instead of failing.
+    """
+    monkeypatch.setenv('MEDCODES_CACHE_DIR', str(tmp_path))
+    mappers = {'stroke_9': {'stroke': ['33'], 'heart': ['4254', '40403']}}
+    vocabularies = {'stroke_9': ['3318', '4254', '40403', '0010']}
+    tables = load_lookup_tables(mappers, vocabularies)
+    path = tmp_path / os.listdir(tmp_path)[0]
+    size = path.stat().st_size
+    with open(path, 'r+b') as f:
+        f.truncate(size // 2)
+    assert(load_lookup_tables(mappers, vocabularies) == tables)
+    assert(path.stat().st_size == size)
+
+def test_compiled_mapper_minimizes_prefixes():
+    """
+    Test that CompiledMapper removes duplicate and subsumed prefixes.
+    """
+    mapper = CompiledMapper({'stroke': ['33', '330', '33'], 'heart': ['4254', '425']})
+    assert(mapper.mapper == {'stroke': ['33'], 'heart': ['425']})
+    assert(mapper.categories == ('stroke', 'heart'))
+
+def test_compiled_mapper_matches_custom_comorbidities():
+    """
+    Test that CompiledMapper.map_one() and map_many() match
+    custom_comorbidities() and comorbidities().
+    """
+    custom_map = {'stroke': ['33'], 'heart': ['425']}
+    mapper = CompiledMapper(custom_map, icd_version=9)
+    icd_codes = ['3318', '82320', '4254']
+    for c in icd_codes:
+        assert(mapper.map_one(c) == custom_comorbidities(c, 9, custom_map))
+    expected = comorbidities(icd_codes, mapping='custom', custom_map=custom_map)
+    assert(mapper.map_many(icd_codes).equals(expected))
+
+def test_compiled_mapper_patient_matrix():
+    """
+    Test that CompiledMapper.patient_matrix() returns one column
+    per custom category.
+    """
+    mapper = CompiledMapper({'stroke': ['33'], 'heart': ['425']})
+    claims = pd.DataFrame({'patient_id': [1, 1, 2], 'icd_code': ['3318', '82320', '4254']})
+    output = mapper.patient_matrix(claims)
+    assert(list(output.columns) == ['stroke', 'heart'])
+    assert(list(output['stroke']) == [True, False])
+    assert(list(output['heart']) == [False, True])
+
+def test_compiled_mapper_schema_error():
+    """
+    Test that CompiledMapper raises a TypeError when values
+    of custom_map are not lists.
+    """
+    with pytest.raises(TypeError):
+        CompiledMapper({'stroke': '33'})
+
+def test_custom_map_code_ranges():
+    """
+    Test that custom maps accept code ranges, with or without dots,
+    and that ranges include every code starting with the upper bound.
+    """
+    custom_map = {'ami': ['410.00-410.92'], 'ihd': ['I20-I25']}
+    assert(custom_comorbidities('41091', 9, custom_map) == ['ami'])
+    assert(custom_comorbidities('4111', 9, custom_map) == [])
+    mapper = CompiledMapper(custom_map, icd_version=10)
+    output = mapper.map_many(['I200', 'I259', 'I260', 'I10'])
+    assert(list(output['custom_comorbidity']) == [['ihd'], ['ihd'], [], []])
+
+def test_custom_map_invalid_range_error():
+    """
+    Test that a range with a lower bound above its upper bound
+    raises a ValueError.
+    """
+    with pytest.raises(ValueError):
+        CompiledMapper({'ihd': ['I25-I20']}, icd_version=10)
+
+def test_custom_map_exclusions():
+    """
+    Test that entries starting with '!' exclude codes from a
+    category, for prefixes and ranges.
+    """
+    custom_map = {'ulcer': ['531-534', '!5310', '!532-533'], 'any ulcer': ['531-534']}
+    assert(custom_comorbidities('5317', 9, custom_map) == ['ulcer', 'any ulcer'])
+    assert(custom_comorbidities('5310', 9, custom_map) == ['any ulcer'])
+    output = comorbidities(['5317', '5310', '5329', '5349'], mapping='custom', custom_map=custom_map)
+    assert(list(output['custom_comorbidity']) == [['ulcer', 'any ulcer'], ['any ulcer'],
+                                                  ['any ulcer'], ['ulcer', 'any ulcer']])
+
+def test_mapper_report_builtin():
+    """
+    Test that mapper_report() lists the duplicate prefixes of
+    the built-in mappers.
+    """
+    report = mapper_report(mapping='charlson', icd_version=9)
+    assert(list(report.columns) == ['comorbidity', 'entry', 'reason', 'kept'])
+    duplicates = report[report['comorbidity'] == 'cerebrovascular disease']
+    assert(sorted(duplicates['entry']) == ['430', '431', '432', '433', '434', '435', '436', '437', '438'])
+
+def test_mapper_report_custom():
+    """
+    Test that CompiledMapper.report() lists duplicate and
+    subsumed entries.
+    """
+    mapper = CompiledMapper({'stroke': ['33', '330', '33', '!3301']})
+    report = mapper.report()
+    assert(list(report['entry']) == ['33', '330'])
+    assert(list(report['reason']) == ['duplicate', 'subsumed'])
+    assert(list(report['kept']) == ['33', '33'])
+
+def test_pack_codes_order():
+    """
+    Test that pack_codes() preserves the order of codes, round-trips
+    with unpack_codes() and returns -1 for codes it cannot pack.
+    """
+    icd_codes = ['4254', '425', '0010', 'V427', 'E8490', 'I252', '']
+    packed = pack_codes(icd_codes)
+    assert([icd_codes[i] for i in np.argsort(packed)] == sorted(icd_codes))
+    assert(list(unpack_codes(packed)) == icd_codes)
+    assert(list(pack_codes(['sd', '1234567890123'])) == [-1, -1])
+
+def test_packed_matching_equals_prefix_matching():
+    """
+    Test that matching packed codes against intervals gives the same
+    bitmasks as walking the prefix trie, including ranges, exclusions
+    and codes that cannot be packed.
+    """
+    custom_map = {'ulcer': ['531-534', '!5310'], 'heart': ['42', '!4254'], 'other': ['sd']}
+    index = PrefixIndex(custom_map)
+    icd_codes = pd.Series(['5317', '5310', '4254', '4280', 'sd', '0010'], dtype=object)
+    expected = [index.match_mask(c) for c in icd_codes]
+    assert(list(index.match_masks(icd_codes)) == expected)
+    index = PrefixIndex({'ulcer': ['531-534', '!5310'], 'heart': ['42', '!4254']})
+    assert(list(index.match_masks(icd_codes)) == [1, 0, 0, 2, 0, 0])
+
+def test_validate_icd_codes():
+    """
+    Test that validate_icd_codes() returns a mask and the reason
+    each code is invalid instead of raising errors.
+    """
+    icd_codes = ['4254', '42.54', None, 3, '4254']
+    valid, reasons = validate_icd_codes(icd_codes, return_reasons=True)
+    assert(list(valid) == [True, False, False, False, True])
+    assert(list(reasons) == ['valid', 'unknown', 'missing', 'not_string', 'valid'])
+    valid = validate_icd_codes(pd.Series(icd_codes, index=list('abcde')))
+    assert(list(valid.index) == list('abcde'))
+    with pytest.raises(ValueError):
+        validate_icd_codes(icd_codes, icd_version=8)
+
+def test_comorbidities_errors():
+    """
+    Test that comorbidities() skips invalid codes with errors='coerce',
+    matches unrecognized strings with errors='ignore' and rejects other
+    values of errors.
+    """
+    icd_codes = ['4254', '42.54', None, 3]
+    output = comorbidities(icd_codes, mapping='charlson', errors='coerce')
+    assert(list(output['charlson_comorbidity'].map(len)) == [1, 0, 0, 0])
+    output = comorbidities(icd_codes, mapping='charlson', errors='ignore')
+    assert(list(output['charlson_comorbidity'].map(len)) == [1, 1, 0, 0])
+    with pytest.raises(TypeError):
+        comorbidities(icd_codes, errors='raise')
+    with pytest.raises(ValueError):
+        comorbidities(icd_codes, errors='skip')
+    claims = pd.DataFrame({'patient_id': [1, 1, 2], 'icd_code': ['4254', 'sd', None]})
+    matrix = comorbidity_matrix(claims, mapping='charlson', errors='coerce')
+    assert(list(matrix.sum(axis=1)) == [1, 0])
+
+def test_format_icd_codes():
+    """
+    Test that dotted, lowercase, padded and E/V codes are normalized
+    the same way by _format_icd_code() and _format_icd_codes().
+    """
+    icd_codes = ['425.4', ' 4254 ', 'v2.1', 'e8.1', 'E11.9', 'i25.2', '4.1', None]
+    expected = {9: ['4254', '4254', 'V021', 'E0081', 'E0119', 'I252', '0041'],
+                10: ['4254', '4254', 'V021', 'E081', 'E119', 'I252', '0041']}
+    for icd_version in [9, 10]:
+        formatted = _format_icd_codes(pd.Series(icd_codes, dtype=object), icd_version)
+        assert(list(formatted[:-1]) == expected[icd_version])
+        assert(pd.isna(formatted.iloc[-1]))
+        assert([_format_icd_code(c, icd_version) for c in icd_codes[:-1]] == expected[icd_version])
+
+def test_comorbidities_dotted_codes():
+    """
+    Test that dotted and lowercase codes are normalized before
+    they are validated.
+    """
+    assert(charlson('425.4') == charlson('4254'))
+    output = comorbidities(['425.4', ' 4254', 'i25.2'], icd_version=10, mapping='charlson', errors='coerce')
+    assert(list(output['description'].isna()) == [True, True, False])
+    output = comorbidities(['425.4', ' 4254'], mapping='charlson')
+    assert(output['description'].nunique() == 1)
+
+def test_comorbidities_multiple_mappings():
+    """
+    Test that comorbidities() with a list of mappings gives the same
+    columns as one call per mapping.
+    """
+    icd_codes = ['4254', 'V427', '4011', '4254']
+    custom_map = {'heart': ['42']}
+    output = comorbidities(icd_codes, mapping=['elixhauser', 'charlson', 'custom'], custom_map=custom_map)
+    assert(list(output.columns) == ['icd_code', 'description', 'elixhauser_comorbidity',
+                                    'charlson_comorbidity', 'custom_comorbidity'])
+    for mapping in ['elixhauser', 'charlson', 'custom']:
+        single = comorbidities(icd_codes, mapping=mapping, custom_map=custom_map, as_bitmask=True)
+        multiple = comorbidities(icd_codes, mapping=[mapping, 'charlson'], custom_map=custom_map, as_bitmask=True)
+        assert(single[f'{mapping}_comorbidity'].equals(multiple[f'{mapping}_comorbidity']))
+    with pytest.raises(ValueError):
+        comorbidities(icd_codes, mapping=['elixhauser', 'quan'])
+    with pytest.raises(ValueError):
+        comorbidities(icd_codes, mapping=[])
+
+def test_infer_icd_version():
+    """
+    Test that infer_icd_version() uses service dates when given and
+    the shape of codes otherwise.
+    """
+    icd_codes = ['4254', 'I252', 'V427', 'E000', None]
+    assert(list(infer_icd_version(icd_codes)) == [9, 10, 9, 9, 9])
+    service_dates = ['2015-09-30', '2015-10-01', None, '2016-01-01', None]
+    assert(list(infer_icd_version(icd_codes, service_dates)) == [9, 10, 9, 10, 9])
+    with pytest.raises(ValueError):
+        infer_icd_version(icd_codes, service_dates[:2])
+
+def test_comorbidities_mixed_versions():
+    """
+    Test that comorbidities() with one ICD version per row matches
+    one call per version and keeps the input order and index.
+    """
+    icd_codes = pd.Series(['4254', 'I509', '4011', 'I10', 'V427'], index=[5, 4, 3, 2, 1])
+    icd_version = [9, 10, 9, 10, 9]
+    output = comorbidities(icd_codes, icd_version=icd_version, mapping=['elixhauser', 'charlson'])
+    assert(list(output.index) == [5, 4, 3, 2, 1])
+    for version in [9, 10]:
+        rows = [v == version for v in icd_version]
+        expected = comorbidities(icd_codes[rows], icd_version=version, mapping=['elixhauser', 'charlson'])
+        assert(output[rows].equals(expected))
+    custom_map = {'heart': ['42', 'I5']}
+    output = comorbidities(icd_codes, icd_version=icd_version, mapping='custom', custom_map=custom_map, as_bitmask=True)
+    assert(list(output['custom_comorbidity']) == [1, 1, 0, 0, 0])
+    with pytest.raises(ValueError):
+        comorbidities(icd_codes, icd_version=icd_version, as_bitmask=True)
+    with pytest.raises(ValueError):
+        comorbidities(icd_codes, icd_version=[9, 10])
+    with pytest.raises(ValueError):
+        comorbidities(icd_codes, icd_version=[9, 10, 9, 10, 8])
+
+def test_comorbidities_mixed_versions_alignment():
+    """
+    Test that comorbidities() aligns a pd.Series of versions to a
+    pd.Series of codes by index label, and raises a ValueError on
+    missing labels.
+    """
+    icd_codes = pd.Series(['4254', 'I509'], index=[3, 4])
+    output = comorbidities(icd_codes, icd_version=pd.Series([10, 9], index=[4, 3]))
+    expected = comorbidities(icd_codes, icd_version=[9, 10])
+    assert(output.equals(expected))
+    with pytest.raises(ValueError):
+        comorbidities(icd_codes, icd_version=pd.Series([9, 10], index=[3, 5]))
+
+def test_wide_comorbidity_matrix():
+    """
+    Test that wide_comorbidity_matrix() skips missing and blank codes, keeps
+    the claims index and matches comorbidity_matrix() on the melted table.
+    """
+    claims = pd.DataFrame({'patient_id': [1, 1, 2], 'dx1': ['4254', '0010', 'V427'],
+                           'dx2': ['40403', None, ''], 'dx3': [None, '5715', '   ']}, index=[10, 11, 12])
+    matrix = wide_comorbidity_matrix(claims, ['dx1', 'dx2', 'dx3'], mapping='charlson')
+    assert(list(matrix.index) == [10, 11, 12])
+    assert(list(matrix.sum(axis=1)) == [2, 1, 1])
+    matrix = wide_comorbidity_matrix(claims, ['dx1', 'dx2', 'dx3'], patient_col='patient_id', mapping='charlson')
+    long_claims = claims.melt(id_vars='patient_id', value_name='icd_code').dropna()
+    long_claims = long_claims[long_claims['icd_code'].str.strip() != '']
+    assert(matrix.equals(comorbidity_matrix(long_claims, mapping='charlson')))
+
+def test_codes_for():
+    """
+    Test that codes_for() lists every vocabulary code that maps to
+    a category, and no other code.
+    """
+    codes = codes_for('congestive heart failure', icd_version=10, mapping='charlson')
+    assert(codes == sorted(codes))
+    assert({'I50', 'I500', 'I509', 'P290'} <= set(codes))
+    output = comorbidities(codes, icd_version=10, mapping='charlson')
+    assert(output['charlson_comorbidity'].map(lambda c: 'congestive heart failure' in c).all())
+    others = comorbidities(['I10', 'I252'], icd_version=10, mapping='charlson')
+    assert(not others['charlson_comorbidity'].map(lambda c: 'congestive heart failure' in c).any())
+    with pytest.raises(ValueError):
+        codes_for('stroke', mapping='charlson')
+
+def test_compiled_mapper_codes_for():
+    """
+    Test that CompiledMapper.codes_for() expands ranges and
+    exclusions, and matches codes_for() with a custom map.
+    """
+    custom_map = {'peptic ulcer': ['531-534', '!5310']}
+    mapper = CompiledMapper(custom_map)
+    codes = mapper.codes_for('peptic ulcer')
+    assert('5311' in codes and '5340' in codes)
+    assert('5310' not in codes and '5350' not in codes)
+    assert(codes_for('peptic ulcer', mapping='custom', custom_map=custom_map) == codes)
+    assert(codes_for('peptic ulcer', mapping='custom', custom_map=mapper) == codes)
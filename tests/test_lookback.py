@@ -0,0 +1,56 @@
+"""
+Lookback
+========
+"""
+
+import pytest
+import numpy as np
+import pandas as pd
+from medcodes.diagnoses import comorbidity_matrix, lookback_comorbidities
+
+
+@pytest.fixture
+def claims():
+    return pd.DataFrame({
+        'patient_id': [1, 1, 1, 2, 2, 3],
+        'icd_code': ['4254', '40403', '0010', '4254', '5715', '4254'],
+        'date': pd.to_datetime(['2013-06-01', '2014-11-02', '2014-11-20', '2014-12-01', '2015-01-01', '2014-01-01'])
+    })
+
+def test_lookback_comorbidities_window(claims):
+    """
+    Test that lookback_comorbidities() only uses claims of the same
+    patient in the window before each event.
+    """
+    events = pd.DataFrame({'patient_id': [1, 2, 2, 4], 'date': pd.to_datetime(['2014-12-01'] * 4)},
+                          index=['a', 'b', 'c', 'd'])
+    flags = lookback_comorbidities(claims, events, window=365, mapping='charlson')
+    assert(list(flags.index) == ['a', 'b', 'c', 'd'])
+    assert(list(flags['congestive heart failure']) == [True, False, False, False])
+    assert(list(flags['renal disease']) == [True, False, False, False])
+    flags = lookback_comorbidities(claims, events, window=365, mapping='charlson', include_event_date=True)
+    assert(list(flags['congestive heart failure']) == [True, True, True, False])
+    assert(not flags['mild liver disease'].any())
+
+def test_lookback_comorbidities_brute_force(claims):
+    """
+    Test that lookback_comorbidities() matches comorbidity_matrix()
+    applied to the claims in the window of each event.
+    """
+    rng = np.random.default_rng(0)
+    events = pd.DataFrame({'patient_id': rng.integers(1, 4, 20),
+                           'date': pd.Timestamp('2013-01-01') + pd.to_timedelta(rng.integers(0, 900, 20), unit='D')})
+    flags = lookback_comorbidities(claims, events, window=300)
+    for i, event in events.iterrows():
+        in_window = claims[(claims['patient_id'] == event['patient_id']) &
+                           (claims['date'] >= event['date'] - pd.Timedelta(days=300)) &
+                           (claims['date'] < event['date'])]
+        expected = comorbidity_matrix(in_window).any(axis=0)
+        assert(set(flags.columns[flags.loc[i]]) == set(expected.index[expected]))
+
+def test_lookback_comorbidities_window_error(claims):
+    """
+    Test that lookback_comorbidities() rejects negative windows.
+    """
+    with pytest.raises(ValueError):
+        lookback_comorbidities(claims, claims, window=-1)
@@ -0,0 +1,82 @@
+"""
+Scoring
+=======
+"""
+
+import pytest
+import pandas as pd
+from medcodes.diagnoses import comorbidity_matrix, charlson_index, elixhauser_index
+from medcodes.diagnoses._mappers import comorbidity_mappers, comorbidity_weights
+
+
+def test_weights_cover_mappers():
+    """
+    Test that every mapper category has a weight.
+    """
+    for k, mapper in comorbidity_mappers.items():
+        assert(list(mapper.keys()) == list(comorbidity_weights[k].keys()))
+
+def test_charlson_index_output():
+    """
+    Test that charlson_index() sums the weights of each patient's
+    comorbidities and returns a pd.Series.
+    """
+    claims = pd.DataFrame({
+        'patient_id': [1, 1, 2],
+        'icd_code': ['4254', '40403', '0010']
+    })
+    matrix = comorbidity_matrix(claims, mapping='charlson')
+    output = charlson_index(matrix)
+    assert(isinstance(output, pd.Series))
+    assert(list(output) == [3, 0])
+
+def test_charlson_index_hierarchy():
+    """
+    Test that metastatic solid tumor supersedes malignancy.
+    """
+    claims = pd.DataFrame({
+        'patient_id': [1, 1],
+        'icd_code': ['1960', '1400']
+    })
+    matrix = comorbidity_matrix(claims, mapping='charlson')
+    assert(list(charlson_index(matrix)) == [6])
+    assert(list(charlson_index(matrix, hierarchy=False)) == [8])
+
+def test_elixhauser_index_output():
+    """
+    Test that elixhauser_index() applies van Walraven weights.
+    """
+    claims = pd.DataFrame({
+        'patient_id': [1, 1],
+        'icd_code': ['4280', '2780']
+    })
+    matrix = comorbidity_matrix(claims, mapping='elixhauser')
+    assert(list(elixhauser_index(matrix)) == [3])
+
+def test_index_unknown_column_error():
+    """
+    Test that charlson_index() raises a ValueError when the matrix
+    has columns that are not Charlson comorbidities.
+    """
+    with pytest.raises(ValueError):
+        charlson_index(pd.DataFrame({'stroke': [True]}))
+
+def test_index_mixed_versions():
+    """
+    Test that a condition flagged by both an ICD-9 and an ICD-10 claim
+    is scored once, and that hierarchy rules apply across versions.
+    """
+    claims = pd.DataFrame({
+        'patient_id': [1, 1, 2, 2, 3, 3],
+        'icd_code': ['3420', 'G810', '5722', 'K721', '5722', 'K703'],
+        'icd_version': [9, 10, 9, 10, 9, 10]
+    })
+    matrix = comorbidity_matrix(claims, version_col='icd_version', mapping='charlson')
+    assert(list(charlson_index(matrix)) == [2, 3, 3])
+    claims = pd.DataFrame({
+        'patient_id': [1, 1],
+        'icd_code': ['2920', 'F110'],
+        'icd_version': [9, 10]
+    })
+    matrix = comorbidity_matrix(claims, version_col='icd_version', mapping='elixhauser')
+    assert(list(elixhauser_index(matrix)) == [-7])
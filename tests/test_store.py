@@ -0,0 +1,53 @@
+"""
+Store
+=====
+"""
+
+import pandas as pd
+from medcodes.diagnoses import ComorbidityStore, comorbidity_matrix
+
+
+def test_store_update():
+    """
+    Test that updating a store day by day gives the same flags as
+    comorbidity_matrix() on the full history, and tracks dates.
+    """
+    claims = pd.DataFrame({'patient_id': [1, 1, 2, 2, 3],
+                           'icd_code': ['4254', '40403', '4254', '5715', '0010'],
+                           'date': pd.to_datetime(['2014-01-02', '2014-01-01', '2014-01-02', '2014-01-03', '2014-01-03'])})
+    store = ComorbidityStore(mapping='charlson')
+    for _, day in claims.groupby('date'):
+        store.update(day)
+    assert(len(store) == 3)
+    flags = store.query().drop(columns=['first_seen', 'last_seen', 'count'])
+    expected = comorbidity_matrix(claims, mapping='charlson')
+    assert(flags.sort_index()[expected.columns].equals(expected))
+    dates = store.query([1, 2, 4])
+    assert(list(dates['first_seen'][:2].astype(str)) == ['2014-01-01', '2014-01-02'])
+    assert(list(dates['last_seen'][:2].astype(str)) == ['2014-01-02', '2014-01-03'])
+    assert(dates.loc[4].isna().sum() == 2)
+
+def test_store_mixed_versions():
+    """
+    Test that a store combines ICD-9 and ICD-10 claims of the same patient.
+    """
+    store = ComorbidityStore(mapping='charlson')
+    store.update(pd.DataFrame({'patient_id': [1], 'icd_code': ['4254'], 'date': ['2015-01-01']}))
+    store.update(pd.DataFrame({'patient_id': [1], 'icd_code': ['N189'], 'date': ['2016-01-01'],
+                               'icd_version': [10]}), version_col='icd_version')
+    flags = store.query([1])
+    assert(flags.loc[1, 'congestive heart failure'] and flags.loc[1, 'renal disease'])
+    assert(str(flags.loc[1, 'last_seen'].date()) == '2016-01-01')
+
+def test_store_save_load(tmp_path):
+    """
+    Test that a store can be saved, loaded and updated again.
+    """
+    path = str(tmp_path / 'store.npz')
+    store = ComorbidityStore(mapping='custom', custom_map={'heart': ['42', '!4254']})
+    store.update(pd.DataFrame({'patient_id': ['a', 'b'], 'icd_code': ['4280', '4254'], 'date': ['2014-01-01'] * 2}))
+    store.save(path)
+    loaded = ComorbidityStore.load(path)
+    assert(loaded.query().equals(store.query()))
+    loaded.update(pd.DataFrame({'patient_id': ['b'], 'icd_code': ['4281'], 'date': ['2014-02-01']}))
+    assert(list(loaded.query()['heart']) == [True, True])
@@ -0,0 +1,98 @@
+"""
+Streaming
+=========
+"""
+
+import pytest
+import pandas as pd
+from medcodes.diagnoses import comorbidities, comorbidities_from_file
+
+
+@pytest.fixture
+def claims_csv(tmp_path):
+    path = tmp_path / 'claims.csv'
+    claims = pd.DataFrame({
+        'patient_id': [1, 1, 2, 3, 3],
+        'icd_code': ['40403', '0010', '4254', '4254', '3318']
+    })
+    claims.to_csv(path, index=False)
+    return str(path)
+
+def test_comorbidities_from_file_chunks(claims_csv):
+    """
+    Test that comorbidities_from_file() yields chunks that match
+    comorbidities() and carries over keep_cols.
+    """
+    chunks = list(comorbidities_from_file(claims_csv, keep_cols=['patient_id'], chunksize=2))
+    assert(len(chunks) == 3)
+    output = pd.concat(chunks)
+    expected = comorbidities(['40403', '0010', '4254', '4254', '3318'])
+    assert(list(output['elixhauser_comorbidity']) == list(expected['elixhauser_comorbidity']))
+    assert(list(output['patient_id']) == [1, 1, 2, 3, 3])
+
+def test_comorbidities_from_file_output(claims_csv, tmp_path):
+    """
+    Test that comorbidities_from_file() writes every chunk to output.
+    """
+    output = str(tmp_path / 'output.csv')
+    comorbidities_from_file(claims_csv, mapping='charlson', as_bitmask=True,
+                            chunksize=2, output=output)
+    written = pd.read_csv(output, dtype={'icd_code': str})
+    assert(list(written['icd_code']) == ['40403', '0010', '4254', '4254', '3318'])
+    assert(list(written['charlson_comorbidity']) == [32776, 0, 8, 8, 0])
+
+def test_comorbidities_from_file_format_error(tmp_path):
+    """
+    Test that comorbidities_from_file() raises a ValueError when the
+    file format cannot be inferred.
+    """
+    with pytest.raises(ValueError):
+        comorbidities_from_file(str(tmp_path / 'claims.xlsx'))
+
+def test_comorbidities_from_file_parquet(claims_csv, tmp_path):
+    """
+    Test that comorbidities_from_file() reads and writes Parquet files.
+    """
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path / 'claims.parquet')
+    pd.read_csv(claims_csv, dtype={'icd_code': str}).to_parquet(path)
+    output = str(tmp_path / 'output.parquet')
+    comorbidities_from_file(path, chunksize=2, output=output)
+    written = pd.read_parquet(output)
+    expected = comorbidities(['40403', '0010', '4254', '4254', '3318'])
+    assert(list(map(list, written['elixhauser_comorbidity'])) == list(expected['elixhauser_comorbidity']))
+
+def test_comorbidities_from_file_parquet_no_matches(tmp_path):
+    """
+    Test that comorbidities_from_file() writes Parquet files when the
+    first chunk has no matches, or only invalid codes and missing values.
+    """
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path / 'claims.parquet')
+    pd.DataFrame({
+        'icd_code': ['0010', '0010', '4254', '40403'],
+        'note': [None, None, 'a', 'b']
+    }).to_parquet(path)
+    output = str(tmp_path / 'output.parquet')
+    comorbidities_from_file(path, chunksize=2, keep_cols=['note'], output=output)
+    written = pd.read_parquet(output)
+    assert(list(written['elixhauser_comorbidity'].map(len)) == [0, 0, 1, 3])
+    assert(list(written['note'])[2:] == ['a', 'b'])
+
+    path = str(tmp_path / 'invalid.csv')
+    pd.DataFrame({'icd_code': ['XXXX', 'YYYY', '4254', '40403']}).to_csv(path, index=False)
+    comorbidities_from_file(path, chunksize=2, errors='coerce', output=output)
+    written = pd.read_parquet(output)
+    assert(list(written['description'].isna()) == [True, True, False, False])
+    assert(list(written['elixhauser_comorbidity'].map(len)) == [0, 0, 1, 3])
+
+    path = str(tmp_path / 'claims.csv')
+    pd.DataFrame({
+        'icd_code': ['4254', '40403', '0010', '4254'],
+        'pid': [None, None, 'a', 'b'],
+        'id': ['1', '2', '3', 'x']
+    }).to_csv(path, index=False)
+    comorbidities_from_file(path, chunksize=2, keep_cols=['pid', 'id'], output=output)
+    written = pd.read_parquet(output)
+    assert(list(written['pid'])[2:] == ['a', 'b'])
+    assert(list(written['id']) == ['1', '2', '3', 'x'])